@@ -8,6 +8,18 @@ Usage:
     groomer = HtmlGroomer(settings, html)
     groomed = groomer.getGroomed()
 
+Batch usage, compiling the settings once:
+    config = HGConfig(settings)
+    groomed = [HtmlGroomer(config, html).getGroomed() for html in docs]
+
+Streaming usage, for documents too big to hold:
+    groomer = HtmlGroomer(settings)
+    for fragment in groomer.iterGroomed(chunks):
+        out.write(fragment)
+
+The command line and the grooming server are in html_groomer_cli,
+python -m html_groomer runs it.
+
 TODO:
     * &#8209; type entity bug
     * is_inline closing tags
@@ -18,75 +30,474 @@ TODO:
 """
 
 import string
+import sys
+import os
 import re
+import time
+import hashlib
+import functools
+import heapq
+import bisect
 import logging
-from collections import OrderedDict
-try:
-    from html.parser import HTMLParser
-except ImportError:
-    from HTMLParser import HTMLParser
-try:
-    from urllib.parse import urlparse
-except ImportError:
-     from urlparse import urlparse
-
-logging.basicConfig(level=logging.WARNING, format='%(name)s: %(funcName)s: %(message)s') #%(module)s: %(levelname)s:
-
-def sortedDict(old=OrderedDict(), order=[]):
-    # singleton utility function
-    new = OrderedDict()
-    for key in order:
-        if key in old.keys():
-            new[key] = old[key]
-            del old[key]
-    # everything else
-    for key in sorted(old):
-        new[key] = old[key]
-    return new
+from collections import OrderedDict, deque
+from html.parser import HTMLParser
+
+# element tracing, see setTracing()
+_trace = False
+
+def sortedDict(old=None, order=()):
+    # singleton utility function: keys in order first, everything else sorted
+    old = old or {}
+    return OrderedDict((key, old[key]) for key in HGOrder(order).sortedKeys(old))
+
+
+def compiledSettings(settings):
+    # singleton utility function: accept sublime settings, a dict or an HGConfig
+    if isinstance(settings, HGConfig):
+        return settings
+    return HGConfig(settings)
+
+
+def settingsFingerprint(values):
+    # stable hash of the effective settings and of the groomer code itself
+    import json
+    canonical = json.dumps(values, sort_keys=True, default=_canonicalSetting)
+    return hashlib.sha256((codeFingerprint() + canonical).encode('utf-8')).hexdigest()
+
+
+def _canonicalSetting(value):
+    if isinstance(value, frozenset):
+        return sorted(value)
+    if hasattr(value, 'pattern'):
+        return [value.pattern, value.flags]
+    raise TypeError(value)
+
+
+# the hexcolor_pat the fused post pass is known to be exact with
+fusable_hexcolor_pattern = r'''(:#|"#|'#| #)([a-fA-F0-9]{3,6})(;| |}|"|')'''
+# corrections whose keys could start or end inside a hex color or
+# conditional could see or spoil another pass's work
+_unfusable_key_chars = frozenset('#<>[]!')
+_unfusable_key_ends = frozenset(':"\' ;}' + string.hexdigits)
+
+
+def trieRegex(words):
+    """
+    A regex matching any of words, shaped as a trie so every position is
+    checked against all of them in one go, Aho-Corasick style
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = None
+
+    def branch(node):
+        alternatives = [re.escape(char) + branch(child) for char, child in sorted(node.items()) if char]
+        if not alternatives:
+            return ''
+        if len(alternatives) == 1 and '' not in node:
+            return alternatives[0]
+        pattern = '(?:{})'.format('|'.join(alternatives))
+        return pattern + '?' if '' in node else pattern
+
+    return branch(trie)
+
+
+def _overlaps(left, right):
+    # a proper suffix of left is a prefix of right
+    return any(right.startswith(left[i:]) for i in range(1, len(left)))
+
+
+def canFusePost(values):
+    """
+    Whether the hex color, conditional and custom correction passes can
+    run as one. Not where a pass could see or spoil another's output, as
+    then only running them one after the other gives the right answer.
+    """
+    if values['hexcolor_pat'].pattern != fusable_hexcolor_pattern or values['hexcolor_pat'].flags != re.UNICODE:
+        return False
+    corrections = values['custom_corrections']
+    for key, value in corrections:
+        if not key or not value or _unfusable_key_chars.intersection(key):
+            return False
+        if key[0] in _unfusable_key_ends or key[-1] in _unfusable_key_ends:
+            return False
+        for other, other_value in corrections:
+            if other == key:
+                continue
+            # a key inside or across another, or one a replacement could make
+            if key in other or _overlaps(key, other):
+                return False
+            if other in value or value in other or _overlaps(value, other) or _overlaps(other, value):
+                return False
+    return True
+
+
+_code_fingerprint = None
+
+
+def codeFingerprint():
+    # cached results must not outlive a change to the groomer
+    global _code_fingerprint
+    if _code_fingerprint is None:
+        try:
+            with open(__file__, 'rb') as f:
+                _code_fingerprint = hashlib.sha256(f.read()).hexdigest()
+        except (IOError, OSError, NameError):
+            _code_fingerprint = ''
+    return _code_fingerprint
+
+
+def setTracing(enabled=True):
+    """
+    Log every element as it's built and laid out, and what HGStack
+    detected, at DEBUG level. Off by default and nothing is formatted
+    until this turns it on.
+    """
+    global _trace
+    _trace = enabled
+    level = logging.DEBUG if enabled else logging.NOTSET
+    for logger in (HtmlGroomer.logger, HGParser.logger, HGStack.logger, HGElement.logger):
+        logger.setLevel(level)
+    if enabled and not logging.getLogger().handlers:
+        logging.basicConfig(format='%(name)s: %(funcName)s: %(message)s')
+
+
+class HGCancelled(Exception):
+
+    """
+    Raised by a progress callback to abandon a groom part way through
+    """
+
+
+class HGConfig():
+
+    """
+    HGConfig is a read only snapshot of the groomer settings. Lists used
+    for membership tests become frozensets, mappings become tuples of pairs
+    and patterns are compiled, so nothing in the grooming pipeline goes
+    back to the settings object once the snapshot is built.
+    Usage:
+        config = HGConfig(settings)
+        groomer = HtmlGroomer(config, html)
+    Reusing one snapshot across documents also reuses its css and tag
+    rendering memos.
+    """
+
+    memo_entries = 4096
+
+    def __init__(self, settings):
+        get = settings.get
+        values = {
+            'groomer_type': get('groomer_type'),
+            'indent_unit': get('indent_unit'),
+            'indent_conditionals': bool(get('indent_conditionals')),
+            'break_unit': get('break_unit'),
+            'tab_size': get('tab_size'),
+            'force_xhtml': bool(get('force_xhtml')),
+            'expand_hexcolors': bool(get('expand_hexcolors')),
+            'use_native_indent': bool(get('use_native_indent')),
+            'format_css': bool(get('format_css')),
+            'merge_percent_width': bool(get('merge_percent_width')),
+            'movable_ink_alt': get('movable_ink_alt'),
+            'tokenizer': get('tokenizer') or 'htmlparser',
+            'compact': bool(get('compact')),
+            }
+        for key in (
+                'keep_inner_whitespace',
+                'double_break_before',
+                'double_break_after',
+                'delete_tags',
+                'dont_increase_indent',
+                'never_xhtml',
+                'startendtags',
+                'boolean_attrs',
+                'inline_elements',
+                'block_elements',
+                ):
+            values[key] = frozenset(get(key) or ())
+        for key in ('css_props_expanded', 'custom_corrections'):
+            values[key] = tuple((get(key) or {}).items())
+        for key in ('html_attrs_sort_order', 'css_props_sort_order'):
+            values[key] = tuple(get(key) or ())
+        for key, flags in (
+                ('hexcolor_pat', 0),
+                ('xhtml_pat', re.IGNORECASE),
+                ('ampscript_pat', re.MULTILINE | re.IGNORECASE),
+                ('conditional_pat', re.MULTILINE | re.IGNORECASE),
+                ('movable_ink_pat', re.IGNORECASE),
+                ):
+            values[key] = re.compile(get(key), flags)
+        values['is_email'] = values['groomer_type'] == 'html_email'
+        values['fingerprint'] = settingsFingerprint(values)
+        values['corrections'] = dict(values['custom_corrections'])
+        values['corrections_pat'] = None
+        if values['corrections']:
+            values['corrections_pat'] = re.compile(trieRegex(values['corrections']))
+        values['fuse_post'] = canFusePost(values)
+        # only reported on, the output doesn't depend on it
+        values['byte_budget'] = int(get('byte_budget') or 0)
+        # rendering memos, they only ever hold results of this snapshot
+        values['css_memo'] = HGMemo(self.memo_entries)
+        values['html_attrs_order'] = HGOrder(values['html_attrs_sort_order'], self.memo_entries)
+        values['css_props_order'] = HGOrder(values['css_props_sort_order'], self.memo_entries)
+        values['tag_memo'] = HGMemo(self.memo_entries)
+        self.__dict__.update(values)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('HGConfig is read only: {}'.format(name))
+
+    def __delattr__(self, name):
+        raise AttributeError('HGConfig is read only: {}'.format(name))
+
+    def memoCounts(self):
+        return {
+            'css_memo_hits': self.css_memo.hits,
+            'css_memo_misses': self.css_memo.misses,
+            'tag_memo_hits': self.tag_memo.hits,
+            'tag_memo_misses': self.tag_memo.misses,
+            }
+
+
+def _byStart(order, matches):
+    # (start, order, match) to merge on, heapq.merge takes no key before 3.5
+    for match in matches:
+        yield match.start(), order, match
 
 
 class HtmlGroomer():
 
-    def __init__(self, settings, raw_content):
-        self.settings = settings
-        self.logger = logging.getLogger('HtmlGroomer')
-        self.logger.setLevel(logging.WARNING)
-        content = raw_content
-        if self.settings.get('indent_conditionals'):
-            content = self.hideConditionals(content)
-        self.parser = HGParser(self.settings, content)
+    # hidden conditionals, as HGElement renders them
+    reveal_pat = re.compile(r'<!--(?:\[if [^!][^\]]+\]|!\[endif\])-->')
+
+    # in stream mode xhtml and native indent are detected from this much input
+    stream_sniff_size = 65536
+
+    logger = logging.getLogger('HtmlGroomer')
+
+    def __init__(self, settings, raw_content=None, base_indent=0, document=None, progress=None, stats=None,
+                 layout_jobs=None):
+        """
+        raw_content None starts stream mode. To groom part of a document pass
+        the indent of its top level elements as base_indent and the whole
+        document, which xhtml and the native indent are detected from.
+        progress is called as progress(phase, done, total) while parsing
+        and laying out, and may raise HGCancelled to stop. Pass an HGStats
+        as stats to time the phases and count what they did. layout_jobs
+        above 1 lays out big documents on that many processes. In stream
+        mode a document to detect xhtml and the native indent from saves
+        waiting for the first stream_sniff_size of the stream.
+        """
+        self.config = compiledSettings(settings)
+        self.progress = progress
+        self.stats = stats
+        self.layout_jobs = layout_jobs
+        self.document = document
+        if raw_content is None:
+            # stream mode, see feed()
+            self.parser = None
+            self.layout = None
+            self._raw = ''
+            self._held = []
+        else:
+            if stats is not None:
+                stats.count('chars_in', len(raw_content))
+            self.parser = self.timed('parse', parserClass(self.config), self.config, raw_content,
+                                     base_indent=base_indent, document=document, progress=progress, stats=stats)
 
     def getGroomed(self):
-        content = self.parser.stack.groomed_html
+        if self.layout_jobs and self.layout_jobs > 1:
+            groomed = self.timed('layout', self.parser.stack.groomedHtmlParallel, self.layout_jobs, self.progress)
+        else:
+            groomed = self.timed('layout', self.parser.stack.groomedHtml, self.progress)
+        groomed = self.timed('post', self.postProcess, groomed)
+        if self.stats is not None:
+            self.stats.count('chars_out', len(groomed))
+        return groomed
+
+    def timed(self, phase, function, *args, **kwargs):
+        # with stats off this is a plain call
+        if self.stats is None:
+            return function(*args, **kwargs)
+        memos = self.config.memoCounts()
+        started = time.perf_counter()
+        result = function(*args, **kwargs)
+        self.stats.add(phase, time.perf_counter() - started)
+        for name, n in self.config.memoCounts().items():
+            if n > memos[name]:
+                self.stats.count(name, n - memos[name])
+        return result
+
+    def feed(self, chunk):
+        """
+        Stream mode: feed the next chunk of the document and get back a
+        list of the groomed fragments which are final so far
+        """
+        self._raw += chunk
+        if self.stats is not None:
+            self.stats.count('chars_in', len(chunk))
+        if self.parser is None and self.document is None and len(self._raw) < self.stream_sniff_size:
+            return []
+        return self._pump(final=False)
+
+    def close(self):
+        # stream mode: the rest of the groomed fragments
+        return self._pump(final=True)
+
+    def iterGroomed(self, chunks):
+        for chunk in chunks:
+            for fragment in self.feed(chunk):
+                yield fragment
+        for fragment in self.close():
+            yield fragment
+
+    def _pump(self, final):
+        if self.parser is None:
+            self.parser = parserClass(self.config)(self.config, self._raw, stream=True, document=self.document,
+                                                   stats=self.stats)
+            self.layout = HGLayout(self.parser.stack)
+        content, self._raw = self._raw, ''
+        self.timed('parse', self.parser.feed, content)
+        if final:
+            self.timed('parse', self.parser.close)
+        fragments = self.timed('layout', self.layoutTaken, final)
+        # post passes only see whole lines, so cut where a fragment starts one
+        held = self._held
+        held.extend(fragments)
+        if final:
+            cut = len(held)
+        elif self.config.compact:
+            cut = self.compactCut(held)
+        else:
+            cut = 0
+            for f in range(len(held) - 1, 0, -1):
+                if held[f].startswith(self.parser.stack.break_unit):
+                    cut = f
+                    break
+        content = ''.join(held[:cut])
+        del held[:cut]
+        if content:
+            content = self.timed('post', self.postProcess, content)
+            if self.stats is not None:
+                self.stats.count('chars_out', len(content))
+            return [content]
+        return []
+
+    def compactCut(self, held):
+        """
+        Compact output has no line breaks to cut at, so cut before a
+        fragment that starts a tag: hex colors end before a < and hidden
+        conditionals are whole fragments. Custom corrections can be any
+        text, so not where one of their keys could run across the cut or
+        past what's held.
+        """
+        corrections_pat = self.config.corrections_pat
+        if corrections_pat is not None:
+            text = ''.join(held)
+            longest = max([len(key) for key in self.config.corrections])
+        at = sum(len(fragment) for fragment in held)
+        for f in range(len(held) - 1, 0, -1):
+            at -= len(held[f])
+            if not held[f].startswith('<'):
+                continue
+            if corrections_pat is None:
+                return f
+            if at + longest > len(text):
+                continue
+            for begin in range(max(at - longest + 1, 0), at):
+                match = corrections_pat.match(text, begin)
+                if match is not None and match.end() > at:
+                    break
+            else:
+                return f
+        return 0
+
+    def layoutTaken(self, final):
+        # stream mode: lay out the elements parsed since the last call
+        fragments = []
+        for element in self.parser.stack.takeElements():
+            fragments.extend(self.layout.push(element))
+        if final:
+            fragments.extend(self.layout.close())
+        return fragments
+
+    def postProcess(self, content):
+        if self.config.fuse_post:
+            return self.fusedPostProcess(content)
         content = self.formatHexColors(content)
-        if self.settings.get('indent_conditionals'):
+        if self.config.indent_conditionals:
             content = self.revealConditionals(content)
         content = self.customCorrections(content)
         return content
 
+    def fusedPostProcess(self, content):
+        """
+        The post passes as one sweep. Conditionals and corrections are rare,
+        so each is found with a scan of its own, which keeps re's fast
+        literal prefix search, and they're merged in document order. Hex
+        colors can't cross either, so the text between gets the hex pass
+        and the output is built in one go instead of once per pass.
+        """
+        config = self.config
+        scans = []
+        if config.indent_conditionals:
+            scans.append(self.reveal_pat.finditer(content))
+        if config.corrections_pat is not None:
+            scans.append(config.corrections_pat.finditer(content))
+        stats = self.stats
+        pieces = []
+        at = 0
+        for start, order, match in heapq.merge(*[_byStart(order, scan) for order, scan in enumerate(scans)]):
+            if start < at:
+                # a correction inside a conditional, which had its own passes
+                continue
+            pieces.append(self.formatHexColors(content[at:start]))
+            if match.re is config.corrections_pat:
+                pieces.append(config.corrections[match.group()])
+                if stats is not None:
+                    stats.count('custom_corrections')
+            else:
+                pieces.append(self.revealConditional(match.group()))
+            at = match.end()
+        if not at:
+            return self.formatHexColors(content)
+        pieces.append(self.formatHexColors(content[at:]))
+        return ''.join(pieces)
+
+    def revealConditional(self, content):
+        # the passes in their usual order, over one hidden conditional
+        if content[4] == '[':
+            content = self.formatHexColors(content)[:-3] + '>'
+        else:
+            content = '<' + content[4:]
+        if self.config.custom_corrections:
+            content = self.customCorrections(content)
+        return content
+
     def formatHexColors(self, content):
-        matches = re.compile(self.settings.get('hexcolor_pat'))
         replace = self.formatHexColor
-        return matches.sub(replace, content)
+        content, count = self.config.hexcolor_pat.subn(replace, content)
+        if self.stats is not None:
+            self.stats.count('hex_colors', count)
+        return content
 
     def formatHexColor(self, pat):
-        if (len(pat.group(2)) == 3) and self.settings.get('expand_hexcolors'):
+        if (len(pat.group(2)) == 3) and self.config.expand_hexcolors:
             return pat.group(1) + pat.group(2).upper() + pat.group(2).upper() + pat.group(3)
         else:
             return pat.group(1) + pat.group(2).upper() + pat.group(3)
 
-    def hideConditionals(self, content):
-        content = re.sub(r'(<!--\[if [^!][^\]]+\])>', r'\1-->', content)
-        content = re.sub(r'<(\!\[endif\]-->)', r'<!--\1', content)
-        return content
-
     def revealConditionals(self, content):
         content = re.sub(r'(<!--\[if [^!][^\]]+\])-->', r'\1>', content)
         content = re.sub(r'<!--(!\[endif\]-->)', r'<\1', content)
         return content
 
     def customCorrections(self, content):
-        for key, val in self.settings.get('custom_corrections').items():
+        for key, val in self.config.custom_corrections:
+            if self.stats is not None:
+                self.stats.count('custom_corrections', content.count(key))
             content = content.replace(key, val)
         return content
 
@@ -98,55 +509,98 @@ class HGParser(HTMLParser):
     Usage:
         parser = HGParser(settings, html)
         stack = parser.stack
+    With stream=True html is only used to detect xhtml and the native indent,
+    feed() and close() the document and collect stack.takeElements() as you go.
     """
 
     strict = False
     convert_charrefs = True
 
-    def __init__(self, settings, raw_content):
+    # with a progress callback the content is fed this much at a time
+    progress_chunk_size = 65536
+
+    logger = logging.getLogger('HGParser')
+
+    # with indent_conditionals these are comments of their own, so the
+    # markup between them is groomed too
+    conditional_open_pat = re.compile(r'<!--\[if [^!][^\]]+\]>')
+    conditional_close = '<![endif]-->'
+
+    def __init__(self, settings, raw_content, stream=False, base_indent=0, document=None, progress=None, stats=None):
         super().__init__()
         self.reset()
-        self.settings = settings
-        self.logger = logging.getLogger('HGParser')
-        self.logger.setLevel(logging.WARNING)
-        self.stack = HGStack(self.settings, raw_content)
+        self.config = compiledSettings(settings)
+        self.stack = HGStack(self.config, raw_content, base_indent, document, stats)
         self._data = ''
-        super().feed(raw_content)
-        super().close()
+        if not stream:
+            if progress is None:
+                super().feed(raw_content)
+            else:
+                total = len(raw_content)
+                for begin in range(0, total, self.progress_chunk_size):
+                    super().feed(raw_content[begin:begin + self.progress_chunk_size])
+                    progress('parse', min(begin + self.progress_chunk_size, total), total)
+            super().close()
+
+    def parse_comment(self, i, report=1):
+        if not self.config.indent_conditionals:
+            return super().parse_comment(i, report)
+        rawdata = self.rawdata
+        end = super().parse_comment(i, 0)
+        # an opener cuts the comment it's in short, right after its ]
+        match = self.conditional_open_pat.search(rawdata, i, end if end >= 0 else len(rawdata))
+        if match is None or (end >= 0 and match.end() - 1 > rawdata.rfind('--', i + 4, end)):
+            return super().parse_comment(i, report)
+        if report:
+            self.countConditional()
+            self.handle_comment(rawdata[i + 4:match.end() - 1])
+        return match.end()
+
+    def parse_html_declaration(self, i):
+        if self.config.indent_conditionals and self.rawdata.startswith(self.conditional_close, i):
+            self.countConditional()
+            self.handle_comment('![endif]')
+            return i + len(self.conditional_close)
+        return super().parse_html_declaration(i)
+
+    def countConditional(self):
+        if self.stack.stats is not None:
+            self.stack.stats.count('conditionals')
 
     def handle_starttag(self, name, attrs):
         self._feed_data()
-        if name in self.settings.get('delete_tags') and not attrs:
+        if name in self.config.delete_tags and not attrs:
             pass
         else:
-            if name in self.settings.get('startendtags'):
+            if name in self.config.startendtags:
                 self.handle_startendtag(name, attrs)
             else:
                 self.stack.feedElement(is_xhtml=self.stack.is_xhtml, kind='starttag', name=name, attrs=attrs)
 
     def handle_endtag(self, name):
         self._feed_data()
-        if name in self.settings.get('delete_tags') and name != self.stack.getLastElement().parent.name:
+        parent = self.stack.getLastElement().parent
+        if name in self.config.delete_tags and (parent is None or name != parent.name):
             pass
         else:
             self.stack.feedElement(kind='endtag', name=name)
 
     def handle_startendtag(self, name, attrs):
         self._feed_data()
-        if name in self.settings.get('delete_tags') and not attrs:
+        if name in self.config.delete_tags and not attrs:
             pass
         else:
             self.stack.feedElement(is_xhtml=self.stack.is_xhtml, kind='startendtag', name=name, attrs=attrs)
 
     def handle_comment(self, content):
         self._feed_data()
-        if re.search(self.settings.get('conditional_pat'), content, re.MULTILINE | re.IGNORECASE):
+        if self.config.conditional_pat.search(content):
             name = 'conditional'
-        elif re.search(self.settings.get('ampscript_pat'), content, re.MULTILINE | re.IGNORECASE):
+        elif self.config.ampscript_pat.search(content):
             name = 'ampscript'
         else:
             name = 'plain'
-        if not name in self.settings.get('delete_tags'):
+        if not name in self.config.delete_tags:
             self.stack.feedElement(kind='comment', name=name, content=content)
 
     def handle_decl(self, content):
@@ -159,11 +613,11 @@ class HGParser(HTMLParser):
 
     def handle_data(self, content):
         last_e = self.stack.getLastElement()
-        if (last_e.kind == 'starttag') and last_e.name in self.settings.get('keep_inner_whitespace'):
-            name = last_e.name
+        if (last_e.kind == 'starttag') and last_e.name in self.config.keep_inner_whitespace:
+            # one element for all of it, HGLayout breaks it into lines
             content = self.stack.removeBaseIndent(content)
-            for line in content.splitlines():
-                self.stack.feedElement(kind='data', name=name, content=line)
+            if content:
+                self.stack.feedElement(kind='data', name=last_e.name, content=content)
         else:
             self._data += content
 
@@ -179,30 +633,219 @@ class HGParser(HTMLParser):
             self._data = ''
 
 
+class HGRegexParser(HGParser):
+
+    """
+    HGParser with a faster tokenizer for the html seen in email templates.
+    Well formed tags, comments and doctypes are matched by one compiled
+    regex; anything else goes to HTMLParser's own parse methods, so the
+    elements built are the same as HGParser's.
+    Usage:
+        parser = HGRegexParser(settings, html)
+        stack = parser.stack
+    or set tokenizer to regex in the settings.
+    """
+
+    token_pat = re.compile(r'''
+        <(?:
+            (?P<start>[a-zA-Z][^\t\n\r\f />\x00]*)
+            (?P<attrs>(?:\s+[^\s"'<>/=]+(?:\s*=\s*(?:"[^"]*"|'[^']*'|[^\s"'<>=`]+(?=[\s>])))?)*)
+            \s*(?P<close>/?)>
+          | /\s*(?P<end>[a-zA-Z][-.a-zA-Z0-9:_]*)\s*>
+          | !--(?P<comment>.*?)--\s*>
+          | !(?P<decl>[dD][oO][cC][tT][yY][pP][eE][^>]*)>
+        )''', re.VERBOSE | re.DOTALL)
+    attr_pat = re.compile(r'''\s+([^\s"'<>/=]+)(?:\s*=\s*("[^"]*"|'[^']*'|[^\s"'<>=`]+))?''')
+    starttag_open_pat = re.compile('<[a-zA-Z]')
+    charref_end_pat = re.compile(r'[\s;]')
+
+    def __init__(self, *args, **kwargs):
+        # html.unescape is 3.4+, so it's only imported when this tokenizer
+        # is picked and the module still loads in Sublime's 3.3 plugin host
+        from html import unescape
+        self._unescape = unescape
+        super().__init__(*args, **kwargs)
+
+    def goahead(self, end):
+        # HTMLParser.goahead with convert_charrefs, tags come from token_pat
+        unescape = self._unescape
+        rawdata = self.rawdata
+        i = 0
+        n = len(rawdata)
+        while i < n:
+            if self.cdata_elem:
+                match = self.interesting.search(rawdata, i)
+                if match is None:
+                    break
+                j = match.start()
+                if i < j:
+                    self.handle_data(rawdata[i:j])
+            else:
+                j = rawdata.find('<', i)
+                if j < 0:
+                    # hold back a charref that may be cut in half
+                    amppos = rawdata.rfind('&', max(i, n - 34))
+                    if not end and amppos >= 0 and not self.charref_end_pat.search(rawdata, amppos):
+                        break
+                    j = n
+                if i < j:
+                    self.handle_data(unescape(rawdata[i:j]))
+                if j == n:
+                    i = self.updatepos(i, n)
+                    break
+            # keeps getpos at the token start, as HTMLParser does
+            i = self.updatepos(i, j)
+            match = self.token_pat.match(rawdata, i)
+            if match is not None:
+                i = self.updatepos(i, self.handleToken(match))
+                continue
+            k = self.parseOther(i, n)
+            if k is None:
+                break
+            if k < 0:
+                if not end:
+                    break
+                k = rawdata.find('>', i + 1)
+                if k < 0:
+                    k = rawdata.find('<', i + 1)
+                    if k < 0:
+                        k = i + 1
+                else:
+                    k += 1
+                if self.cdata_elem:
+                    self.handle_data(rawdata[i:k])
+                else:
+                    self.handle_data(unescape(rawdata[i:k]))
+            i = self.updatepos(i, k)
+        if end and i < n and not self.cdata_elem:
+            self.handle_data(unescape(rawdata[i:n]))
+            i = self.updatepos(i, n)
+        self.rawdata = rawdata[i:]
+
+    def handleToken(self, match):
+        name = match.group('start')
+        if name is not None:
+            name = name.lower()
+            attrs = []
+            for attr in self.attr_pat.finditer(match.group('attrs')):
+                key, val = attr.groups()
+                if val is not None and val[:1] in '"\'':
+                    val = val[1:-1]
+                if val:
+                    val = self._unescape(val)
+                attrs.append((key.lower(), val))
+            if match.group('close'):
+                self.handle_startendtag(name, attrs)
+            else:
+                self.handle_starttag(name, attrs)
+                if name in self.CDATA_CONTENT_ELEMENTS:
+                    self.set_cdata_mode(name)
+            return match.end()
+        name = match.group('end')
+        if name is not None:
+            name = name.lower()
+            if self.cdata_elem is not None and name != self.cdata_elem:
+                self.handle_data(match.group())
+            else:
+                self.handle_endtag(name)
+                self.clear_cdata_mode()
+            return match.end()
+        if match.group('comment') is not None:
+            if self.config.indent_conditionals:
+                # may hold a conditional opener, see HGParser.parse_comment
+                return self.parse_comment(match.start())
+            self.handle_comment(match.group('comment'))
+            return match.end()
+        self.handle_decl(match.group('decl'))
+        return match.end()
+
+    def parseOther(self, i, n):
+        # what HTMLParser.goahead does at a < token_pat doesn't match,
+        # None to wait for more input
+        rawdata = self.rawdata
+        if self.starttag_open_pat.match(rawdata, i):
+            return self.parse_starttag(i)
+        elif rawdata.startswith('</', i):
+            return self.parse_endtag(i)
+        elif rawdata.startswith('<!--', i):
+            return self.parse_comment(i)
+        elif rawdata.startswith('<?', i):
+            return self.parse_pi(i)
+        elif rawdata.startswith('<!', i):
+            return self.parse_html_declaration(i)
+        elif i + 1 < n:
+            self.handle_data('<')
+            return i + 1
+        return None
+
+
+# tokenizer backends by the name used in the tokenizer setting
+tokenizers = {
+    'htmlparser': HGParser,
+    'regex': HGRegexParser,
+    }
+
+
+def parserClass(settings):
+    # singleton utility function: the HGParser class the settings ask for
+    config = compiledSettings(settings)
+    try:
+        return tokenizers[config.tokenizer]
+    except KeyError:
+        raise ValueError('unknown tokenizer: {}'.format(config.tokenizer))
+
+
 class HGStack():
 
     """
     HGStack represents an HTML document as an ordered and
-    indexed list of HGElement objects. It's not a DOM tree.
+    indexed list of HGElement objects. It's not a DOM tree, but it
+    keeps an index of the tree as elements are fed: the partner of each
+    start and end tag, and the positions of each tag and attribute name.
     """
 
-    def __init__(self, settings, raw_content):
-        self.settings = settings
-        self._raw_content = raw_content
-        self.logger = logging.getLogger('HGStack')
-        self.logger.setLevel(logging.WARNING)
+    logger = logging.getLogger('HGStack')
+
+    tabs_pat = re.compile(r'^(\t+)', re.MULTILINE)
+    spaces_pat = re.compile(r'^( +)', re.MULTILINE)
+
+    def __init__(self, config, raw_content, base_indent=0, document=None, stats=None):
+        self.config = config
+        self.stats = stats
+        # instrumented elements only when stats are on
+        if stats is None:
+            self.newElement = HGElement
+        else:
+            self.newElement = functools.partial(HGTimedElement, stats)
+        # xhtml and the native indent come from the whole document
+        self._raw_content = raw_content if document is None else document
+        self.base_indent = base_indent
         self.ancestors = []
         self.elements = []
+        # start tag index <-> end tag index
+        self.partners = {}
+        # tag or attribute name -> ascending indices of the tags with it
+        self.tag_positions = {}
+        self.attr_positions = {}
+        # (rule, element, message) for end tags that close nothing or the
+        # wrong tag, once HGLint sets it to a list; until then they're warnings
+        self.findings = None
+        # the parser's getpos, set to give each element a (line, offset) position
+        self.getpos = None
+        # elements dropped from the front by takeElements
+        self.released = 0
+        self._taken = 0
         # self.is_xhtml
-        if self.settings.get('force_xhtml'):
+        if self.config.force_xhtml:
             self._is_xhtml = True
-        elif re.search(self.settings.get('xhtml_pat'), self._raw_content, re.IGNORECASE):
+        elif self.config.xhtml_pat.search(self._raw_content):
             self._is_xhtml = True
         else:
             self._is_xhtml = False
-        self._break_unit = self.settings.get('break_unit')
-        self.tab_size = self.settings.get('tab_size')
-        self.use_native_indent = self.settings.get('use_native_indent')
+        self._break_unit = self.config.break_unit
+        self.tab_size = self.config.tab_size
+        self.use_native_indent = self.config.use_native_indent
+        self._native_indent = self.detectNativeIndent()
         if self.native_indent != '\t':
             self.indent_tabs = False
             self.native_tab_size = len(self.native_indent)
@@ -213,16 +856,17 @@ class HGStack():
             self._indent_unit = self.native_indent
             self.convert_indent = False
         else:
-            self._indent_unit = self.settings.get('indent_unit')
+            self._indent_unit = self.config.indent_unit
             self.convert_indent = True
-        self.logger.info('force_xhtml: {!s}'.format(self.settings.get('force_xhtml')))
-        self.logger.info('is_xhtml: {!s}'.format(self.is_xhtml))
-        self.logger.info('native_indent: {!r}'.format(self.native_indent))
-        self.logger.info('native_tab_size: {}'.format(self.native_tab_size))
-        self.logger.info('use_native_indent: {!s}'.format(self.use_native_indent))
-        self.logger.info('indent_tabs: {!s}'.format(self.indent_tabs))
-        self.logger.info('convert_indent: {!s}'.format(self.convert_indent))
-        self.logger.info('indent_unit: {!s}'.format(self.indent_unit))
+        if _trace:
+            self.logger.info('force_xhtml: %s', self.config.force_xhtml)
+            self.logger.info('is_xhtml: %s', self.is_xhtml)
+            self.logger.info('native_indent: %r', self.native_indent)
+            self.logger.info('native_tab_size: %s', self.native_tab_size)
+            self.logger.info('use_native_indent: %s', self.use_native_indent)
+            self.logger.info('indent_tabs: %s', self.indent_tabs)
+            self.logger.info('convert_indent: %s', self.convert_indent)
+            self.logger.info('indent_unit: %r', self.indent_unit)
 
     @property
     def break_unit(self):
@@ -238,118 +882,123 @@ class HGStack():
 
     @property
     def native_indent(self):
-        tabs = []
-        spaces = []
-        tabs_pat = re.compile(r'^(\t+)', re.MULTILINE)
-        spaces_pat = re.compile(r'^( +)', re.MULTILINE)
-        for match in tabs_pat.finditer(self._raw_content):
-            tabs.append(match.groups())
-        for match in spaces_pat.finditer(self._raw_content):
-            spaces.append(match.groups())
+        return self._native_indent
+
+    def detectNativeIndent(self):
+        # the indent most lines start with, the raw content is scanned once
+        tabs = self.tabs_pat.findall(self._raw_content)
+        spaces = self.spaces_pat.findall(self._raw_content)
         if len(tabs) == len(spaces):
-            return self.settings.get('indent_unit')
+            return self.config.indent_unit
         elif len(tabs) > len(spaces):
-            return tabs[0][0]
+            return tabs[0]
         else:
-            return spaces[0][0]
+            return spaces[0]
 
     @property
     def groomed_html(self):
+        return self.groomedHtml()
+
+    def groomedHtml(self, progress=None, progress_every=4096):
+        layout = HGLayout(self)
+        spaced = []
+        total = len(self.elements)
+        for i, this_e in enumerate(self.elements):
+            spaced.extend(layout.push(this_e))
+            if progress is not None and not i % progress_every:
+                progress('layout', i, total)
+        spaced.extend(layout.close())
+        if progress is not None:
+            progress('layout', total, total)
+        return ''.join(spaced)
+
+    def groomedHtmlParallel(self, jobs, progress=None):
+        """
+        groomedHtml with the layout spread over a pool of jobs processes.
+        The elements are split where the layout carries nothing across, so
+        the result is the same as groomedHtml's. The elements here are left
+        as parsed, not laid out.
+        """
+        total = len(self.elements)
+        # a few partitions per job to even out the load
+        partitions = self.partitions(jobs * 4)
+        if self.stats is not None:
+            self.stats.count('layout_partitions', len(partitions))
+        if len(partitions) < 2:
+            return self.groomedHtml(progress)
+        tasks = [self.partitionTask(begin, end) for begin, end in partitions]
+        import multiprocessing
+        pool = multiprocessing.Pool(min(jobs, len(tasks)), _initLayoutWorker, (self.config,))
+        try:
+            spaced = []
+            for (begin, end), fragment in zip(partitions, pool.imap(_layoutPartition, tasks)):
+                spaced.append(fragment)
+                if progress is not None:
+                    progress('layout', end, total)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return ''.join(spaced)
+
+    def partitions(self, count, min_elements=1024):
+        """
+        Split the elements, before they are laid out, into about count
+        (begin, end) ranges which lay out on their own the same as in one
+        pass. A range starts at a starttag after an element which is not
+        inline, inside ancestors which are not inline. HGLayout.push has
+        decided every inline starttag before such an element.
+        """
         elements = self.elements
-        spaced_elements = []
-        spaced = ''
-        for this_e in elements:
-            next_e = self.getNextElement(this_e.index)
-            last_e = self.getPreviousElement(this_e.index)
-            breaks_before = 0
-            this_indent = this_e.indent
-            # starttag
-            if this_e.kind == 'starttag':
-                if this_e.is_inline:
-                    # this is_not_inline if a child is_not_inline
-                    child = next_e
-                    while child.name != this_e.name:
-                        if child.is_not_inline:
-                            this_e.is_inline = False
-                        child = self.getNextElement(child.index)
-                if last_e.is_inline and this_e.is_inline:
-                    this_indent = 0
-            # endtag
-            elif this_e.kind == 'endtag':
-                if last_e.is_inline and this_e.is_inline:
-                    this_indent = 0
-                else:
-                    # find our starttag in prior_e
-                    prior_e = last_e
-                    while (prior_e.kind != 'starttag') and (prior_e.name != this_e.name):
-                        prior_e = self.getPreviousElement(prior_e.index)
-                    # if our starttag is_not_inline because something inside is_not_inline neither is this
-                    if prior_e.is_not_inline: this_e.is_inline = False
-            # text
-            elif (this_e.name == 'text') and (this_e.kind == 'data'):
-                if last_e.is_inline:
-                    this_indent = 0
-                    if last_e.kind == 'starttag':
-                        # last element was inline start tag
-                        this_e.content = this_e.content.lstrip()
-                if last_e.is_not_inline:
-                    # last element was not inline so strip left
-                    this_e.content = this_e.content.lstrip()
-                if next_e.is_not_inline:
-                    this_e.content = this_e.content.rstrip()
-                elif next_e.kind == 'endtag':
-                    # next element is inline end tag
-                    this_e.content = this_e.content.rstrip()
-                if not this_e.content:
-                    # skip this_e, it was just whitespace we don't need
+        total = len(elements)
+        if self.released or count < 2 or total < 2 * min_elements:
+            return [(0, total)]
+        size = max(min_elements, total // count)
+        bounds = [0]
+        seen_start = False
+        seen_names = set()
+        partners = self.partners
+        e = 0
+        while e < total:
+            element = elements[e]
+            kind = element.kind
+            name = element.name
+            if kind == 'endtag' and not seen_start and name not in seen_names:
+                # waits for the end of the document, and so does all after it
+                return [(0, total)]
+            seen_names.add(name)
+            if kind == 'starttag':
+                seen_start = True
+                if e - bounds[-1] >= size and elements[e - 1].is_not_inline:
+                    bounds.append(e)
+                if element.is_inline:
+                    # nothing under an inline element starts a range
+                    e = partners.get(e, total)
                     continue
-            # line breaks
-            if this_e.index == 0:
-                breaks_before = 0
-            elif (
-                    (this_e.name == 'text') and
-                    (this_e.kind == 'data') and
-                    (this_e.content == '&nbsp;') and
-                    (last_e.kind == 'starttag') and
-                    (next_e.kind == 'endtag')
-                ):
-                # collapse semi-empty containers
-                this_indent = 0
-                breaks_before = 0
-                next_e.is_collapsed = True
-            elif this_e.is_collapsed:
-                this_indent = 0
-                breaks_before = 0
-            elif (
-                    (last_e.name == this_e.name) and
-                    (last_e.kind == 'starttag') and
-                    (this_e.kind == 'endtag')
-                ):
-                # collapse empty containers
-                this_indent = 0
-                breaks_before = 0
-            elif (this_e.name == 'br') and (last_e.name == 'br'):
-                # multiple br on the same line
-                this_indent = 0
-                breaks_before = 0
-            elif (last_e.name == 'br') and (this_e.name != 'br'):
-                breaks_before += 1
-                if last_e.name in self.settings.get('double_break_after'):
-                    breaks_before += 1
-            elif this_e.is_not_inline or last_e.is_not_inline:
-                breaks_before += 1
-            # append it
-            spaced += self.break_unit * breaks_before
-            spaced += self.indent_unit * this_indent
-            spaced += this_e.html
-            this_e.debug({'breaks_before':breaks_before, 'this_indent': this_indent,})
-        return spaced
+            e += 1
+        bounds.append(total)
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def partitionTask(self, begin, end):
+        # what _layoutPartition needs to lay out elements[begin:end]
+        elements = self.elements
+        context = elements[begin].ancestors
+        rows = [_elementRow(element) for element in context + elements[begin:end]]
+        last = _elementRow(elements[begin - 1]) if begin > 0 else None
+        following = _elementRow(elements[end]) if end < len(elements) else None
+        return (len(context), rows, last, following, self.break_unit, self.indent_unit)
 
     def getElement(self, e=None):
         try:
+            if e >= 0:
+                e -= self.released
+                if e < 0:
+                    raise IndexError(e)
             return self.elements[e]
         except IndexError:
-            return HGElement(settings=self.settings)
+            return HGElement(config=self.config)
 
     def getPreviousElement(self, e):
         return self.getElement(e - 1)
@@ -361,15 +1010,23 @@ class HGStack():
         return self.getElement(-1)
 
     def feedElement(self, is_xhtml=False, kind=None, name=None, content=None, attrs=[]):
+        index = self.released + len(self.elements)
+        start = None
         if kind == 'endtag':
             try:
-                self.ancestors.pop()
+                start = self.ancestors.pop()
+                self.partners[start.index] = index
+                self.partners[index] = start.index
             except IndexError:
-                self.logger.warning('*** Extra closing tag. No ancestors to pop.')
-        element = HGElement(
-            settings=self.settings,
-            index=len(self.elements),
-            ancestors=list(self.ancestors),
+                if self.findings is None:
+                    self.logger.warning('*** Extra closing tag. No ancestors to pop.')
+        elif kind == 'starttag' or kind == 'startendtag':
+            self.indexTag(index, name, attrs)
+        element = self.newElement(
+            config=self.config,
+            index=index,
+            parent=self.ancestors[-1] if self.ancestors else None,
+            indent=self.base_indent,
             is_xhtml=is_xhtml,
             kind=kind,
             name=name,
@@ -377,81 +1034,470 @@ class HGStack():
             attrs=attrs,
             )
         self.elements.append(element)
+        if self.getpos is not None:
+            element.position = self.getpos()
+        if kind == 'endtag' and self.findings is not None:
+            if start is None:
+                self.findings.append(('extra-closing-tag', element, '</{}> closes nothing'.format(name)))
+            elif start.name != name:
+                self.findings.append(('mismatched-closing-tag', element, '</{}> closes <{}>'.format(name, start.name)))
+        if self.stats is not None:
+            self.stats.countElement(kind, len(self.ancestors))
         if kind == 'starttag':
             self.ancestors.append(element)
 
+    def takeElements(self):
+        # hand over elements fed since the last call, holding on to
+        # just the last one for the parser to look back at
+        taken = self.elements[self._taken - self.released:]
+        self._taken = self.released + len(self.elements)
+        if len(self.elements) > 1:
+            self.released += len(self.elements) - 1
+            del self.elements[:-1]
+            # the index only covers the elements still held
+            self.partners.clear()
+            self.tag_positions.clear()
+            self.attr_positions.clear()
+            last_e = self.elements[0]
+            if last_e.kind == 'starttag' or last_e.kind == 'startendtag':
+                self.indexTag(last_e.index, last_e.name, last_e.attributes.items())
+        return taken
+
+    def indexTag(self, index, name, attrs):
+        self.tag_positions.setdefault(name, []).append(index)
+        for attr in attrs:
+            positions = self.attr_positions.setdefault(attr[0], [])
+            # a repeated attribute is listed once
+            if not positions or positions[-1] != index:
+                positions.append(index)
+
+    def partner(self, element):
+        # the end tag of a start tag or the start tag of an end tag, None if unmatched
+        index = self.partners.get(element.index)
+        if index is None or index < self.released:
+            return None
+        return self.elements[index - self.released]
+
+    def extent(self, element):
+        """
+        (begin, end) indices of element and everything under it, through
+        its end tag. An open start tag runs to the last element fed.
+        """
+        begin = element.index
+        if element.kind != 'starttag':
+            return begin, begin + 1
+        end = self.partners.get(begin)
+        if end is None:
+            return begin, self.released + len(self.elements)
+        return begin, end + 1
+
+    def descendants(self, element):
+        # the elements under a start tag, without its end tag
+        begin, end = self.extent(element)
+        if element.index in self.partners:
+            end -= 1
+        return self.elements[max(begin + 1 - self.released, 0):max(end - self.released, 0)]
+
+    def select(self, name=None, within=None, attrs=None, missing=()):
+        """
+        The tags called name, or any tag, under the within start tag or in
+        the whole stack, which have the attrs (a dict, a value of None
+        matches any value) and lack the attribute names in missing. Walks
+        the shortest of the position lists for name and attrs between the
+        bounds of within, so it doesn't scan the document:
+            stack.select('img', missing=['alt'])
+            stack.select(within=td, attrs={'href': None})
+        """
+        attrs = attrs or {}
+        released = self.released
+        if within is None:
+            begin, end = released, released + len(self.elements)
+        else:
+            begin, end = self.extent(within)
+            begin += 1
+        lists = [self.tag_positions.get(name, [])] if name is not None else []
+        lists.extend(self.attr_positions.get(attr, []) for attr in attrs)
+        if lists:
+            ranges = [(bisect.bisect_left(positions, begin), bisect.bisect_left(positions, end), positions)
+                      for positions in lists]
+            low, high, positions = min(ranges, key=lambda r: r[1] - r[0])
+            candidates = [self.elements[index - released] for index in positions[low:high]]
+        else:
+            candidates = [element for element in self.elements[max(begin - released, 0):max(end - released, 0)]
+                          if element.kind == 'starttag' or element.kind == 'startendtag']
+        selected = []
+        for element in candidates:
+            if name is not None and element.name != name:
+                continue
+            if attrs or missing:
+                attributes = element.attributes
+                if any(attr not in attributes or (value is not None and attributes[attr] != value)
+                       for attr, value in attrs.items()):
+                    continue
+                if any(attr in attributes for attr in missing):
+                    continue
+            selected.append(element)
+        return selected
+
     def removeBaseIndent(self, content):
-        base_pat = '^({})+'.format(self.indent_unit)
-        indent_pat = ''
-        cleaned = []
-        lines = content.splitlines()
-        for l, line in enumerate(lines):
-            self.logger.debug('{}: {!r}'.format(l, line))
-            if line.strip():
-                # Is this still needed if sublime handles the conversion?
-                if self.convert_indent:
-                    line = re.sub(self.native_indent, self.indent_unit, line)
-                if not indent_pat:
-                    try:
-                        base_indent = re.search(base_pat, line).group(0)
-                    except AttributeError:
-                        base_indent = ''
-                    base_count = len(re.findall(self.indent_unit, base_indent))
-                    indent_pat = '^{}'.format(self.indent_unit * base_count)
-                line = re.sub(indent_pat, '', line, 1)
-                cleaned.append(line)
-        return self.break_unit.join(cleaned)
+        # the non blank lines less the indent of the first, in one pass each
+        lines = [line for line in content.splitlines() if line.strip()]
+        if not lines:
+            return ''
+        if _trace:
+            for l, line in enumerate(lines):
+                self.logger.debug('%s: %r', l, line)
+        # lines hold no newlines, so the patterns can't match across them
+        content = '\n'.join(lines)
+        # Is this still needed if sublime handles the conversion?
+        if self.convert_indent:
+            content = re.sub(self.native_indent, self.indent_unit, content)
+        base_indent = re.match('({})+'.format(self.indent_unit), content)
+        base_count = len(re.findall(self.indent_unit, base_indent.group(0))) if base_indent else 0
+        if base_count:
+            content = re.sub('^{}'.format(self.indent_unit * base_count), '', content, flags=re.MULTILINE)
+        return content.replace('\n', self.break_unit)
 
     def debugElements(self):
         for this_e in self.elements:
             this_e.debug()
 
+    def elementTable(self):
+        # the elements as a list of dicts, for a trace dump
+        return [this_e.trace() for this_e in self.elements]
+
+
+class HGLayout():
+
+    """
+    HGLayout lays out HGElement objects pushed in document order and hands
+    back groomed html fragments as soon as their layout is final. Only the
+    current run of undecided inline elements is held, so memory scales with
+    the length of that run rather than with the document.
+    Usage:
+        layout = HGLayout(stack)
+        fragments = []
+        for element in stack.elements:
+            fragments.extend(layout.push(element))
+        fragments.extend(layout.close())
+    """
+
+    def __init__(self, stack):
+        self.config = stack.config
+        self.break_unit = stack.break_unit
+        self.indent_unit = stack.indent_unit
+        self.compact = self.config.compact
+        # [element, partner, has_block] waiting to be laid out
+        self.pending = deque()
+        # inline starttags waiting on a non-inline element or their partner
+        self.undecided = {}
+        self.last_e = None
+        self.last_fed = None
+        self.last_start = None
+        self.prior_by_name = {}
+        self.closed = False
+
+    def push(self, element):
+        # an element of the same name ends the span of an inline starttag
+        for entry in self.undecided.pop(element.name, ()):
+            entry[2] = False
+        # anything else in the span that is_not_inline makes it a block
+        if element.is_not_inline and self.undecided:
+            for entries in self.undecided.values():
+                for entry in entries:
+                    entry[2] = True
+            self.undecided.clear()
+        entry = [element, None, False]
+        if element.kind == 'starttag':
+            if element.is_inline:
+                entry[2] = None
+                self.undecided.setdefault(element.name, []).append(entry)
+            self.last_start = element
+        elif element.kind == 'endtag':
+            # our starttag is the nearest prior starttag or element of the same name
+            entry[1] = self.laterElement(self.last_start, self.prior_by_name.get(element.name))
+        self.prior_by_name[element.name] = element
+        self.last_fed = element
+        self.pending.append(entry)
+        return self.flush()
+
+    def close(self):
+        self.closed = True
+        # never closed, so these run to the end of the document
+        for entries in self.undecided.values():
+            for entry in entries:
+                entry[2] = True
+        self.undecided.clear()
+        for entry in self.pending:
+            if entry[0].kind == 'endtag' and entry[1] is None:
+                # nothing before us, so the search wraps to the end of the document
+                entry[1] = self.laterElement(self.last_start, self.prior_by_name[entry[0].name])
+        return self.flush()
+
+    def flush(self):
+        fragments = []
+        pending = self.pending
+        while pending:
+            this_e, partner, has_block = pending[0]
+            if len(pending) > 1:
+                next_e = pending[1][0]
+            elif self.closed:
+                next_e = HGElement(config=self.config)
+            else:
+                break
+            if not self.closed:
+                if has_block is None:
+                    break
+                if this_e.kind == 'endtag' and (partner is None or this_e.index == 0):
+                    # these look past the end of the document
+                    break
+            if self.last_e is not None:
+                last_e = self.last_e
+            elif self.closed:
+                # like a negative list index, the first element looks back to the last
+                last_e = self.last_fed
+            else:
+                last_e = HGElement(config=self.config)
+            fragment = self.layoutElement(this_e, last_e, next_e, partner, has_block)
+            if fragment:
+                fragments.append(fragment)
+            self.last_e = this_e
+            pending.popleft()
+        return fragments
+
+    def laterElement(self, *elements):
+        later = None
+        for element in elements:
+            if element is not None and (later is None or element.index > later.index):
+                later = element
+        return later
+
+    def layoutElement(self, this_e, last_e, next_e, partner, has_block):
+        breaks_before = 0
+        # ancestors were laid out first, so any is_inline flips are final
+        this_e.reindent()
+        this_indent = this_e.indent
+        # starttag
+        if this_e.kind == 'starttag':
+            if this_e.is_inline:
+                # this is_not_inline if a child is_not_inline
+                if has_block:
+                    this_e.is_inline = False
+            if last_e.is_inline and this_e.is_inline:
+                this_indent = 0
+        # endtag
+        elif this_e.kind == 'endtag':
+            if last_e.is_inline and this_e.is_inline:
+                this_indent = 0
+            else:
+                # if our starttag is_not_inline because something inside is_not_inline neither is this
+                if partner.is_not_inline: this_e.is_inline = False
+        # text
+        elif (this_e.name == 'text') and (this_e.kind == 'data'):
+            if last_e.is_inline:
+                this_indent = 0
+                if last_e.kind == 'starttag':
+                    # last element was inline start tag
+                    this_e.content = this_e.content.lstrip()
+            if last_e.is_not_inline:
+                # last element was not inline so strip left
+                this_e.content = this_e.content.lstrip()
+            if next_e.is_not_inline:
+                this_e.content = this_e.content.rstrip()
+            elif next_e.kind == 'endtag':
+                # next element is inline end tag
+                this_e.content = this_e.content.rstrip()
+            if not this_e.content:
+                # skip this_e, it was just whitespace we don't need
+                return ''
+        # line breaks
+        if this_e.index == 0:
+            breaks_before = 0
+        elif (
+                (this_e.name == 'text') and
+                (this_e.kind == 'data') and
+                (this_e.content == '&nbsp;') and
+                (last_e.kind == 'starttag') and
+                (next_e.kind == 'endtag')
+            ):
+            # collapse semi-empty containers
+            this_indent = 0
+            breaks_before = 0
+            next_e.is_collapsed = True
+        elif this_e.is_collapsed:
+            this_indent = 0
+            breaks_before = 0
+        elif (
+                (last_e.name == this_e.name) and
+                (last_e.kind == 'starttag') and
+                (this_e.kind == 'endtag')
+            ):
+            # collapse empty containers
+            this_indent = 0
+            breaks_before = 0
+        elif (this_e.name == 'br') and (last_e.name == 'br'):
+            # multiple br on the same line
+            this_indent = 0
+            breaks_before = 0
+        elif (last_e.name == 'br') and (this_e.name != 'br'):
+            breaks_before += 1
+            if last_e.name in self.config.double_break_after:
+                breaks_before += 1
+        elif this_e.is_not_inline or last_e.is_not_inline:
+            breaks_before += 1
+        if _trace:
+            this_e.debug({'breaks_before':breaks_before, 'this_indent': this_indent,})
+        if self.compact:
+            spacing = self.compactSpacing(last_e, this_e) if breaks_before or this_indent else ''
+        else:
+            spacing = self.break_unit * breaks_before + self.indent_unit * this_indent
+        if this_e.kind == 'data' and this_e.name != 'text':
+            return spacing + self.rawLines(this_e)
+        return spacing + this_e.html
+
+    def compactSpacing(self, last_e, this_e):
+        # what the browser makes of the pretty layout's line break and indent
+        if this_e.index == 0:
+            return ''
+        block_elements = self.config.block_elements
+        if last_e.name in block_elements or this_e.name in block_elements:
+            return ''
+        # spaces at either end of a line are dropped
+        if last_e.name == 'br' or this_e.name == 'br':
+            return ''
+        return ' '
+
+    def rawLines(self, this_e):
+        # keep_inner_whitespace content, each line laid out after the one
+        # before as if it were an element of its own
+        if this_e.name == 'br':
+            separator = ''
+        elif self.compact:
+            separator = self.break_unit
+        elif this_e.is_not_inline:
+            separator = self.break_unit + self.indent_unit * this_e.indent
+        else:
+            separator = self.indent_unit * this_e.indent
+        return separator.join(this_e.content.splitlines())
+
+
+def _elementRow(element):
+    # an element as parsed, small enough to send to another process
+    parent = element.parent
+    return (element.index, parent.index if parent is not None else None, element.indent,
+            element.is_xhtml, element.kind, element.name, element.content, element._attrs)
+
+
+def _initLayoutWorker(config):
+    global _layout_config
+    _layout_config = config
+
+
+def _layoutPartition(task):
+    # lay out one of HGStack.partitions() in a worker process
+    context, rows, last, following, break_unit, indent_unit = task
+    config = _layout_config
+    by_index = {}
+
+    def element(row):
+        index, parent_index, indent, is_xhtml, kind, name, content, attrs = row
+        return HGElement(config, index, by_index.get(parent_index), indent, is_xhtml,
+                         kind=kind, name=name, content=content, attrs=attrs)
+
+    elements = []
+    for row in rows:
+        this_e = element(row)
+        by_index[this_e.index] = this_e
+        elements.append(this_e)
+    # HGLayout only needs these of the stack
+    import types
+    layout = HGLayout(types.SimpleNamespace(config=config, break_unit=break_unit, indent_unit=indent_unit))
+    if last is not None:
+        layout.last_e = element(last)
+    fragments = []
+    for this_e in elements[context:]:
+        fragments.extend(layout.push(this_e))
+    if following is None:
+        fragments.extend(layout.close())
+    else:
+        # lays out the last element, which looks ahead at the next one
+        fragments.extend(layout.push(element(following)))
+    return ''.join(fragments)
+
 
 class HGElement():
 
     """
     HGElement represents one element of an HTML document
+    Documents have tens of thousands of these, so they use __slots__,
+    share interned names and keep attributes as a tuple of pairs
     """
 
-    def __init__(self, settings, index=None, ancestors=None, is_xhtml=False, is_collapsed=False, kind=None, name=None, content=None, attrs={}, is_inline=False):
-        self.logger = logging.getLogger('HGElement')
-        self.logger.setLevel(logging.DEBUG)
-        self.settings = settings
+    __slots__ = (
+        'config',
+        '_index',
+        '_parent',
+        '_indent',
+        '_is_xhtml',
+        '_is_collapsed',
+        '_kind',
+        '_name',
+        '_content',
+        '_attrs',
+        '_is_inline',
+        'position',
+        )
+
+    logger = logging.getLogger('HGElement')
+
+    display_block_pat = re.compile(r'display:\s*block', re.IGNORECASE)
+    display_inline_block_pat = re.compile(r'display:\s*inline-block', re.IGNORECASE)
+    display_none_pat = re.compile(r'display:\s*none', re.IGNORECASE)
+    display_inline_pat = re.compile(r'display:\s*inline', re.IGNORECASE)
+
+    def __init__(self, config, index=None, parent=None, indent=0, is_xhtml=False, is_collapsed=False, kind=None, name=None, content=None, attrs={}, is_inline=False):
+        self.config = config
         self._index = index
-        self._ancestors = ancestors
+        self._parent = parent
+        self._indent = parent.inner_indent if parent is not None else indent
         self._is_xhtml = is_xhtml
         self._is_collapsed = is_collapsed
         self._kind = kind
-        self._name = name
+        self._name = sys.intern(name) if name else name
         self._content = content
-        self._attributes = {}
+        # (line, offset) in the source, when HGStack.getpos is set
+        self.position = None
+        attributes = {}
         for attr in attrs:
             """
             HtmlParser will return attrs as a list of tuples:
                 attr[0] is the attribute name
                 attr[1] is the value
                 boolean attributes have a value of None
-            Interate the list and build a dictionary so we can get()
+            Interate the list and build a dictionary so later dupes win,
+            then keep it as a tuple which is far smaller than a dict
             """
-            self._attributes[attr[0]] = attr[1]
+            attributes[sys.intern(attr[0])] = attr[1]
+        self._attrs = tuple(attributes.items())
         # inline styles and settings can impact is_inline
-        styles = self._attributes.get('style')
+        styles = attributes.get('style')
         if styles:
-            if re.search(r'display:\s*block', styles, re.IGNORECASE):
+            if self.display_block_pat.search(styles):
                 self._is_inline = False
-            elif re.search(r'display:\s*inline-block', styles, re.IGNORECASE):
+            elif self.display_inline_block_pat.search(styles):
                 self._is_inline = False
-            elif re.search(r'display:\s*none', styles, re.IGNORECASE):
+            elif self.display_none_pat.search(styles):
                 self._is_inline = False
-            elif re.search(r'display:\s*inline', styles, re.IGNORECASE):
+            elif self.display_inline_pat.search(styles):
                 self._is_inline = True
             elif is_inline:
                 self._is_inline = True
             else:
-                self._is_inline = self.name in self.settings.get('inline_elements')
+                self._is_inline = self.name in self.config.inline_elements
         else:
-            self._is_inline = self.name in self.settings.get('inline_elements')
-        self.debug()
+            self._is_inline = self.name in self.config.inline_elements
+        if _trace:
+            self.debug()
 
     def __repr__(self):
         return self.name
@@ -497,18 +1543,23 @@ class HGElement():
 
     @property
     def attributes(self):
-        return self._attributes
+        # a fresh dict each time, rendering must not change the element
+        return dict(self._attrs)
 
     @property
     def ancestors(self):
-        return self._ancestors
+        # derived from the parent chain, outermost first
+        ancestors = []
+        parent = self._parent
+        while parent is not None:
+            ancestors.append(parent)
+            parent = parent._parent
+        ancestors.reverse()
+        return ancestors
 
     @property
     def parent(self):
-        try:
-            return self.ancestors[-1]
-        except IndexError:
-            return None
+        return self._parent
 
     @property
     def kind(self):
@@ -528,20 +1579,22 @@ class HGElement():
 
     @property
     def indent(self):
-        ancestors = self.ancestors
-        try:
-            depth = len(ancestors)
-        except TypeError:
-            return 0
-        indent = 0
-        for ancestor in ancestors:
-            if ancestor.name in self.settings.get('dont_increase_indent'):
-                pass
-            elif ancestor.is_inline:
-                pass
-            else:
-                indent += 1
-        return indent
+        return self._indent
+
+    @property
+    def inner_indent(self):
+        # the indent of this element's children
+        if self.name in self.config.dont_increase_indent:
+            return self._indent
+        elif self.is_inline:
+            return self._indent
+        else:
+            return self._indent + 1
+
+    def reindent(self):
+        # refresh from the parent after an ancestor's is_inline changed
+        if self._parent is not None:
+            self._indent = self._parent.inner_indent
 
     @property
     def html(self):
@@ -557,7 +1610,7 @@ class HGElement():
             element = "<{}>".format(self.tag_inner)
         elif self.kind == 'startendtag':
             if self.is_xhtml:
-                if self.settings.get('never_xhtml') and (self.settings.get('never_xhtml').count(self.name) > 0):
+                if self.name in self.config.never_xhtml:
                     element = "<{}>".format(self.tag_inner)
                 else:
                     element = "<{} />".format(self.tag_inner)
@@ -569,62 +1622,77 @@ class HGElement():
 
     @property
     def tag_inner(self):
-        if not self.attributes:
+        if not self._attrs:
             return self.name
-        else:
-            attributes = self.attributes
-            merged_styles = {}
-            # urls
-            if attributes.get('href'):
-                attributes['href'] = self.fixUrl(attributes['href'])
-            # html height and width attributes should not have px
-            if attributes.get('height', '').endswith('px'):
-                 attributes['height'] = attributes['height'][:-2]
-            if attributes.get('width', '').endswith('px'):
-                attributes['width'] = attributes['width'][:-2]
-            # html emails
-            if 'html_email' == self.settings.get('groomer_type'):
-                # images
-                if self.name == 'img':
-                    # Default Movable Ink alt text
-                    mi_pat = self.settings.get('movable_ink_pat')
-                    if attributes.get('src') and re.search(mi_pat, attributes['src'], re.IGNORECASE):
-                        if not attributes.get('alt'):
-                            attributes['alt'] = self.settings.get('movable_ink_alt')
-                    # always have alt on img
+        # the same attribute sets come back over and over in templates
+        key = (self._name, self._attrs, self._is_xhtml, self.config.groomer_type)
+        tag_inner = self.config.tag_memo.get(key)
+        if tag_inner is None:
+            tag_inner = self.renderTagInner()
+            self.config.tag_memo.put(key, tag_inner)
+        return tag_inner
+
+    def renderTagInner(self):
+        attributes = self.attributes
+        merged_styles = {}
+        # urls
+        if attributes.get('href'):
+            attributes['href'] = self.fixUrl(attributes['href'])
+        # html height and width attributes should not have px
+        if attributes.get('height', '').endswith('px'):
+             attributes['height'] = attributes['height'][:-2]
+        if attributes.get('width', '').endswith('px'):
+            attributes['width'] = attributes['width'][:-2]
+        # html emails
+        if self.config.is_email:
+            # images
+            if self.name == 'img':
+                # Default Movable Ink alt text
+                if attributes.get('src') and self.config.movable_ink_pat.search(attributes['src']):
                     if not attributes.get('alt'):
-                        attributes['alt'] = ''
-                    # always have border on img, default=0
-                    if not attributes.get('border'):
-                        attributes['border'] = '0'
-                # outlook 120dpi fix: add inline css width where html width exists
-                if attributes.get('width'):
-                    if attributes['width'].endswith('%'):
-                        if self.settings.get('merge_percent_width') :
-                            merged_styles['width'] = attributes['width']
-                    else:
-                        merged_styles['width'] = attributes['width'] + 'px'
-                    if merged_styles.get('width') and not attributes.get('style'):
-                        attributes['style'] = 'width:' + merged_styles['width']
-            # format inline css
-            if attributes.get('style') and self.settings.get('format_css'):
-                attributes['style'] = self.formatCssProps(attributes['style'], merged_styles)
-            # sort and flatten attributes
-            flat_attrs = []
-            for key, val in sortedDict(attributes, self.settings.get('html_attrs_sort_order')).items():
-                if val:
-                    # standard: <tag key="value" ...
-                    flat_attrs.append('{}="{}"'.format(key.strip(), val.strip()))
-                elif key == 'alt':
-                    # allow empty alt: <tag alt="" ...
-                    flat_attrs.append('{}="{}"'.format(key.strip(), val.strip()))
-                elif self.is_xhtml:
-                    # xhmtl spec: <tag boolattr="boolattr" ...
-                    flat_attrs.append('{}="{}"'.format(key.strip(), key.strip()))
+                        attributes['alt'] = self.config.movable_ink_alt
+                # always have alt on img
+                if not attributes.get('alt'):
+                    attributes['alt'] = ''
+                # always have border on img, default=0
+                if not attributes.get('border'):
+                    attributes['border'] = '0'
+            # outlook 120dpi fix: add inline css width where html width exists
+            if attributes.get('width'):
+                if attributes['width'].endswith('%'):
+                    if self.config.merge_percent_width:
+                        merged_styles['width'] = attributes['width']
                 else:
-                    # html spec: <tag boolattr ...
-                    flat_attrs.append(key.strip())
-            return '{} {}'.format(self.name, ' '.join(flat_attrs))
+                    merged_styles['width'] = attributes['width'] + 'px'
+                if merged_styles.get('width') and not attributes.get('style'):
+                    attributes['style'] = 'width:' + merged_styles['width']
+        # format inline css
+        if attributes.get('style') and self.config.format_css:
+            attributes['style'] = self.formatCss(attributes['style'], merged_styles)
+        # sort and flatten attributes
+        flat_attrs = []
+        for key, val in self.config.html_attrs_order.sortedItems(attributes):
+            if val:
+                # standard: <tag key="value" ...
+                flat_attrs.append('{}="{}"'.format(key.strip(), val.strip()))
+            elif key == 'alt':
+                # allow empty alt: <tag alt="" ...
+                flat_attrs.append('{}="{}"'.format(key.strip(), val.strip()))
+            elif self.is_xhtml:
+                # xhmtl spec: <tag boolattr="boolattr" ...
+                flat_attrs.append('{}="{}"'.format(key.strip(), key.strip()))
+            else:
+                # html spec: <tag boolattr ...
+                flat_attrs.append(key.strip())
+        return '{} {}'.format(self.name, ' '.join(flat_attrs))
+
+    def formatCss(self, content, merge):
+        key = (content, tuple(merge.items()))
+        styles = self.config.css_memo.get(key)
+        if styles is None:
+            styles = self.formatCssProps(content, merge)
+            self.config.css_memo.put(key, styles)
+        return styles
 
     def formatCssProps(self, content, merge={}):
         # get a list of all css parts and remove empty elements
@@ -639,7 +1707,7 @@ class HGElement():
             except ValueError:
                 continue
         # expand
-        for key, val in self.settings.get('css_props_expanded').items():
+        for key, val in self.config.css_props_expanded:
             if properties.get(key) and properties[key]:
                 properties[key] = val
         # merge in any properties passed
@@ -647,13 +1715,14 @@ class HGElement():
             properties[key] = val
         # reassemble in sorted order stripping leading/trailing spaces
         parts = []
-        for key, val in sortedDict(properties, self.settings.get('css_props_sort_order')).items():
+        for key, val in self.config.css_props_order.sortedItems(properties):
             parts.append('{}:{}'.format(key.strip(), val.strip()))
         # flatten parts ensuring ; on the last one
         styles = '; '.join(parts)
         return styles + ';'
 
     def fixUrl(self, u):
+        from urllib.parse import urlparse
         url = urlparse(u.strip())
         return url.geturl()
 
@@ -676,4 +1745,972 @@ class HGElement():
                     ' attributes{!r}'.format(self.attributes) if self.attributes else '',
                     ' content:{!r}'.format(self.content) if self.content else '',
                     )
-                )
\ No newline at end of file
+                )
+
+    def trace(self):
+        # one row of HGStack.elementTable()
+        return {
+            'index': self._index,
+            'kind': self._kind,
+            'name': self._name,
+            'depth': len(self.ancestors),
+            'parent': self._parent.index if self._parent is not None else None,
+            'indent': self._indent,
+            'is_inline': self._is_inline,
+            'is_xhtml': self._is_xhtml,
+            'is_collapsed': self._is_collapsed,
+            'attributes': self.attributes,
+            'content': self._content,
+            }
+
+
+class HGTimedElement(HGElement):
+
+    """
+    HGElement that reports its construction and css formatting to an HGStats
+    """
+
+    __slots__ = ('stats',)
+
+    def __init__(self, stats, *args, **kwargs):
+        started = time.perf_counter()
+        self.stats = stats
+        super().__init__(*args, **kwargs)
+        stats.add('elements', time.perf_counter() - started)
+
+    def formatCssProps(self, content, merge={}):
+        started = time.perf_counter()
+        styles = super().formatCssProps(content, merge)
+        self.stats.add('css', time.perf_counter() - started)
+        self.stats.count('css_blocks')
+        return styles
+
+
+class HGStats():
+
+    """
+    Opt-in instrumentation for grooming: wall time per phase and counters
+    Usage:
+        stats = HGStats()
+        groomed = HtmlGroomer(settings, html, stats=stats).getGroomed()
+        print(stats.summary())
+    One HGStats can collect several grooms, the numbers add up.
+    elements is part of parse and css part of layout.
+    """
+
+    phases = ('parse', 'elements', 'layout', 'css', 'post')
+
+    def __init__(self):
+        self.seconds = {}
+        self.counts = {}
+        self.kinds = {}
+        self.max_depth = 0
+
+    def add(self, phase, seconds):
+        self.seconds[phase] = self.seconds.get(phase, 0.0) + seconds
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def countElement(self, kind, depth):
+        self.kinds[kind] = self.kinds.get(kind, 0) + 1
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def merge(self, summary):
+        # add in the summary() of another HGStats, say from a worker process
+        for phase, seconds in summary['seconds'].items():
+            if phase != 'total':
+                self.add(phase, seconds)
+        for name, n in summary['counts'].items():
+            self.count(name, n)
+        for kind, n in summary['elements'].items():
+            self.kinds[kind] = self.kinds.get(kind, 0) + n
+        self.max_depth = max(self.max_depth, summary['max_depth'])
+
+    def summary(self):
+        seconds = dict((phase, self.seconds.get(phase, 0.0)) for phase in self.phases)
+        # elements and css are already inside parse and layout
+        seconds['total'] = sum(seconds[phase] for phase in ('parse', 'layout', 'post'))
+        return {
+            'seconds': seconds,
+            'counts': dict(sorted(self.counts.items())),
+            'elements': dict(sorted(self.kinds.items())),
+            'element_count': sum(self.kinds.values()),
+            'max_depth': self.max_depth,
+            }
+
+    def report(self, out=None):
+        out = out or sys.stderr
+        summary = self.summary()
+        seconds = summary['seconds']
+        total = max(seconds['total'], 1e-9)
+        for phase in self.phases + ('total',):
+            out.write('  {:<10}{:9.4f}s {:6.1f}%\n'.format(phase, seconds[phase], 100 * seconds[phase] / total))
+        out.write('  {} elements, max depth {}: {}\n'.format(
+            summary['element_count'], summary['max_depth'],
+            ', '.join('{} {}'.format(n, kind) for kind, n in summary['elements'].items())))
+        out.write('  {}\n'.format(', '.join('{} {}'.format(n, name) for name, n in summary['counts'].items())))
+        rates = []
+        for memo in ('css_memo', 'tag_memo'):
+            hits = summary['counts'].get(memo + '_hits', 0)
+            lookups = hits + summary['counts'].get(memo + '_misses', 0)
+            if lookups:
+                rates.append('{} {:.1f}%'.format(memo, 100.0 * hits / lookups))
+        if rates:
+            out.write('  hit rates: {}\n'.format(', '.join(rates)))
+
+
+class HGMemo():
+
+    """
+    HGMemo is a small bounded LRU for rendering results, keyed on anything
+    hashable. get() returns None on a miss, so None can not be memoized.
+    Usage:
+        memo = HGMemo(4096)
+        value = memo.get(key)
+        if value is None:
+            value = render()
+            memo.put(key, value)
+    """
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        try:
+            self._entries.move_to_end(key)
+        except KeyError:
+            # evicted by another thread grooming with the same config
+            pass
+        return value
+
+    def put(self, key, value):
+        entries = self._entries
+        entries[key] = value
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def __getstate__(self):
+        # sent to another process a memo starts out empty
+        return {'max_entries': self.max_entries}
+
+    def __setstate__(self, state):
+        self.__init__(state['max_entries'])
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            }
+
+
+class HGOrder():
+
+    """
+    HGOrder sorts keys the way a sort order setting says: listed keys first
+    in the listed order, everything else alphabetically after them. The
+    ranks are looked up once and the order of each distinct key set is
+    remembered, since the same attribute combinations keep coming back.
+    Usage:
+        order = HGOrder(['id', 'class', 'style'])
+        order.sortedKeys({'style': '', 'href': '', 'id': ''})
+    """
+
+    def __init__(self, order=(), max_entries=4096):
+        self.rank = {}
+        for rank, key in enumerate(order):
+            self.rank.setdefault(key, rank)
+        self.memo = HGMemo(max_entries)
+
+    def sortKey(self, key):
+        rank = self.rank.get(key)
+        if rank is None:
+            return (1, 0, key)
+        return (0, rank, '')
+
+    def sortedKeys(self, keys):
+        # the sort does not depend on the order keys come in
+        keys = frozenset(keys)
+        ordered = self.memo.get(keys)
+        if ordered is None:
+            ordered = tuple(sorted(keys, key=self.sortKey))
+            self.memo.put(keys, ordered)
+        return ordered
+
+    def sortedItems(self, mapping):
+        return [(key, mapping[key]) for key in self.sortedKeys(mapping)]
+
+
+class HGCache():
+
+    """
+    HGCache remembers groomed results keyed on a hash of the raw content and
+    the settings fingerprint, so any change to the settings, groomer_type
+    or the groomer itself misses. Results live in an in-memory LRU bounded
+    by total characters, since every pool worker holds its own, and given
+    a path, in a directory shared between runs and processes.
+    Usage:
+        cache = HGCache(path='.groomer-cache')
+        groomed = cache.getGroomed(settings, html)
+        cache.stats()
+    """
+
+    def __init__(self, max_memory_chars=16 * 1024 * 1024, path=None, max_disk_bytes=256 * 1024 * 1024):
+        self.max_memory_chars = max_memory_chars
+        self.path = path
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._memory_chars = 0
+        self._disk_bytes = None
+        self.hits = 0
+        self.misses = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.evictions = 0
+        if path:
+            os.makedirs(path, exist_ok=True)
+
+    def key(self, config, raw_content):
+        digest = hashlib.sha256(config.fingerprint.encode('ascii'))
+        digest.update(raw_content.encode('utf-8', 'surrogatepass'))
+        return digest.hexdigest()
+
+    def getGroomed(self, settings, raw_content):
+        config = compiledSettings(settings)
+        key = self.key(config, raw_content)
+        groomed = self.get(key)
+        if groomed is None:
+            self.misses += 1
+            groomed = HtmlGroomer(config, raw_content).getGroomed()
+            self.put(key, groomed)
+        else:
+            self.hits += 1
+        return groomed
+
+    def get(self, key):
+        groomed = self._memory.get(key)
+        if groomed is not None:
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+            return groomed
+        if self.path:
+            file_path = self.diskPath(key)
+            try:
+                with open(file_path, encoding='utf-8', newline='') as f:
+                    groomed = f.read()
+                # mtime is the last use, which is what eviction goes by
+                os.utime(file_path)
+            except (IOError, OSError):
+                return None
+            self.disk_hits += 1
+            self.remember(key, groomed)
+        return groomed
+
+    def put(self, key, groomed):
+        self.remember(key, groomed)
+        if self.path:
+            file_path = self.diskPath(key)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            writeAtomic(file_path, groomed)
+            if self._disk_bytes is not None:
+                self._disk_bytes += len(groomed.encode('utf-8', 'surrogatepass'))
+            if self.diskBytes() > self.max_disk_bytes:
+                self.evictDisk()
+
+    def remember(self, key, groomed):
+        if len(groomed) > self.max_memory_chars:
+            # would push out everything else, the disk store can have it
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_chars -= len(old)
+        self._memory[key] = groomed
+        self._memory_chars += len(groomed)
+        while self._memory_chars > self.max_memory_chars:
+            key, old = self._memory.popitem(last=False)
+            self._memory_chars -= len(old)
+
+    def diskPath(self, key):
+        return os.path.join(self.path, key[:2], key[2:])
+
+    def diskEntries(self):
+        entries = []
+        for root, dirs, files in os.walk(self.path):
+            for name in files:
+                if name.startswith('.'):
+                    continue
+                file_path = os.path.join(root, name)
+                try:
+                    stat = os.stat(file_path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, file_path))
+        return entries
+
+    def diskBytes(self):
+        # counted once, then kept up to date as we write
+        if self._disk_bytes is None:
+            self._disk_bytes = sum(size for mtime, size, file_path in self.diskEntries())
+        return self._disk_bytes
+
+    def evictDisk(self):
+        # least recently used first, down to 90% so we don't evict on every write
+        entries = sorted(self.diskEntries())
+        total = sum(size for mtime, size, file_path in entries)
+        target = self.max_disk_bytes * 0.9
+        for mtime, size, file_path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(file_path)
+            except OSError:
+                # another process got there first
+                pass
+            total -= size
+            self.evictions += 1
+        self._disk_bytes = total
+
+    def clear(self):
+        self._memory.clear()
+        self._memory_chars = 0
+        if self.path:
+            for mtime, size, file_path in self.diskEntries():
+                try:
+                    os.remove(file_path)
+                except OSError:
+                    pass
+            self._disk_bytes = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'evictions': self.evictions,
+            'entries': len(self._memory),
+            'memory_chars': self._memory_chars,
+            }
+
+
+class HGScanner():
+
+    """
+    HGScanner finds where elements start and end in raw html without
+    building the element stack, so part of a document can be groomed with
+    the indent a full groom would give it. Tags pair up the way HGStack
+    pairs them: an endtag closes whatever was opened last.
+    Usage:
+        scanner = HGScanner(settings, html)
+        begin, end, indent, token = scanner.enclosingBlock(sel_begin, sel_end)
+        breaks = scanner.breaksAfter(token)
+    """
+
+    token_pat = re.compile(r'''
+        (?P<comment><!--.*?-->)
+        |(?P<declaration><![^>]*>)
+        |</(?P<endtag>[a-zA-Z][^\s/>]*)[^>]*>
+        |<(?P<starttag>[a-zA-Z][^\s/>]*)(?P<attrs>(?:[^>"']|"[^"]*"|'[^']*')*)>
+        ''', re.VERBOSE | re.DOTALL)
+    conditional_token_pat = re.compile(r'''
+        (?P<conditional><!--\[if\ [^!][^\]]+\]>|<!\[endif\]-->)
+        |(?P<comment><!--.*?-->)
+        |(?P<declaration><![^>]*>)
+        |</(?P<endtag>[a-zA-Z][^\s/>]*)[^>]*>
+        |<(?P<starttag>[a-zA-Z][^\s/>]*)(?P<attrs>(?:[^>"']|"[^"]*"|'[^']*')*)>
+        ''', re.VERBOSE | re.DOTALL)
+    style_attr_pat = re.compile(r'''\bstyle\s*=\s*("[^"]*"|'[^']*'|[^\s>]+)''', re.IGNORECASE)
+
+    def __init__(self, settings, raw_content):
+        self.config = compiledSettings(settings)
+        self.raw_content = raw_content
+        # (begin, name, is_inline) of everything that becomes an element
+        self.tokens = []
+        # HGElement kind of each token
+        self.kinds = []
+        # (begin, end, token) of every start tag closed by an end tag
+        self.spans = []
+        # token of the start tag each token sits inside
+        self.parents = []
+        # end token of each start token in self.spans
+        self.closers = {}
+        # tokens laid out right after a text element
+        self.after_text = set()
+        # the element HGLayout takes each endtag's partner to be
+        self.layout_partners = {}
+        self._last_start = None
+        self._prior_by_name = {}
+        self._text_pending = False
+        self.scan()
+
+    def scan(self):
+        config = self.config
+        content = self.raw_content
+        token_pat = self.conditional_token_pat if config.indent_conditionals else self.token_pat
+        opened = []
+        pos = 0
+        while True:
+            match = token_pat.search(content, pos)
+            if not match:
+                break
+            text = content[pos:match.start()]
+            pos = match.end()
+            parent = opened[-1] if opened else None
+            if text.strip() or (text and self.tokens and self.tokens[-1][2]):
+                # HGParser makes this text an element, so it's what came last
+                last_parent = parent
+                self._text_pending = True
+            else:
+                last_parent = self.parents[-1] if self.parents else None
+            if match.lastgroup == 'conditional':
+                self.addToken(match.start(), 'conditional', False, parent, 'comment')
+            elif match.lastgroup == 'comment':
+                comment = match.group(0)[4:-3]
+                if config.conditional_pat.search(comment):
+                    name = 'conditional'
+                elif config.ampscript_pat.search(comment):
+                    name = 'ampscript'
+                else:
+                    name = 'plain'
+                if name not in config.delete_tags:
+                    self.addToken(match.start(), name, name in config.inline_elements, parent, 'comment')
+            elif match.lastgroup == 'declaration':
+                self.addToken(match.start(), 'doctype', 'doctype' in config.inline_elements, parent, 'declaration')
+            elif match.group('endtag'):
+                name = match.group('endtag').lower()
+                if name in config.delete_tags and (last_parent is None or self.tokens[last_parent][1] != name):
+                    continue
+                if opened:
+                    start = opened.pop()
+                    self.spans.append((self.tokens[start][0], match.end(), start))
+                    self.closers[start] = len(self.tokens)
+                parent = opened[-1] if opened else None
+                self.addToken(match.start(), name, name in config.inline_elements, parent, 'endtag')
+            else:
+                name = match.group('starttag').lower()
+                attrs = match.group('attrs')
+                if name in config.delete_tags and not attrs.strip(' \t\n\r\f/'):
+                    continue
+                if name in config.startendtags or attrs.rstrip().endswith('/'):
+                    self.addToken(match.start(), name, self.tagIsInline(name, attrs), parent, 'startendtag')
+                    continue
+                token = self.addToken(match.start(), name, self.tagIsInline(name, attrs), parent, 'starttag')
+                opened.append(token)
+                if name in config.keep_inner_whitespace:
+                    # raw text runs to the end tag, and each line is a non-inline element
+                    end = re.compile(r'</{}\s*>'.format(re.escape(name)), re.IGNORECASE).search(content, pos)
+                    stop = end.start() if end else len(content)
+                    if content[pos:stop].strip():
+                        self.addToken(pos, name, name in config.inline_elements, token, 'data')
+                    pos = stop
+
+    def addToken(self, begin, name, is_inline, parent, kind):
+        token = len(self.tokens)
+        self.tokens.append((begin, name, is_inline))
+        self.kinds.append(kind)
+        self.parents.append(parent)
+        if self._text_pending:
+            self.after_text.add(token)
+            self._text_pending = False
+        # HGLayout.push pairs an endtag with the nearest prior starttag or
+        # element of the same name
+        if kind == 'endtag':
+            candidates = [t for t in (self._last_start, self._prior_by_name.get(name)) if t is not None]
+            self.layout_partners[token] = max(candidates) if candidates else None
+        elif kind == 'starttag':
+            self._last_start = token
+        self._prior_by_name[name] = token
+        return token
+
+    def tagIsInline(self, name, attrs):
+        # the same rules as HGElement, where the last style attribute wins
+        styles = ''
+        for match in self.style_attr_pat.finditer(attrs):
+            styles = match.group(1).strip('\'"')
+        if styles:
+            if HGElement.display_block_pat.search(styles):
+                return False
+            elif HGElement.display_inline_block_pat.search(styles):
+                return False
+            elif HGElement.display_none_pat.search(styles):
+                return False
+            elif HGElement.display_inline_pat.search(styles):
+                return True
+        return name in self.config.inline_elements
+
+    def laidOutInline(self, token):
+        # groomed_html makes an inline start tag a block if anything up to
+        # the next element of the same name is_not_inline
+        begin, name, is_inline = self.tokens[token]
+        if not is_inline:
+            return False
+        for later in range(token + 1, len(self.tokens)):
+            if self.tokens[later][1] == name:
+                return True
+            if not self.tokens[later][2]:
+                return False
+        # never closed, so it runs to the end of the document
+        return False
+
+    def elementInline(self, token):
+        # is_inline of the element once HGLayout has laid it out
+        kind = self.kinds[token]
+        if kind == 'starttag':
+            return self.laidOutInline(token)
+        is_inline = self.tokens[token][2]
+        if kind != 'endtag' or not is_inline or token == 0:
+            return is_inline
+        # an inline endtag after inline text or an inline element stays inline
+        if token in self.after_text:
+            if 'text' in self.config.inline_elements:
+                return True
+        elif self.elementInline(token - 1):
+            return True
+        # otherwise it's a block if its partner is
+        partner = self.layout_partners[token]
+        return partner is None or self.elementInline(partner)
+
+    def breaksAfter(self, token):
+        """
+        Whether a full groom starts a new line after the endtag of the
+        block starting at token, and the indent of what comes next
+        """
+        end_token = self.closers[token]
+        next_token = end_token + 1
+        if next_token in self.after_text:
+            next_inline = 'text' in self.config.inline_elements
+            indent = self.indentOf(token)
+        elif next_token < len(self.tokens):
+            next_inline = self.elementInline(next_token)
+            indent = self.indentOf(next_token)
+        else:
+            return False, 0
+        return not (next_inline and self.elementInline(end_token)), indent
+
+    def indentOf(self, token):
+        indent = 0
+        parent = self.parents[token]
+        while parent is not None:
+            if self.tokens[parent][1] in self.config.dont_increase_indent:
+                pass
+            elif self.laidOutInline(parent):
+                pass
+            else:
+                indent += 1
+            parent = self.parents[parent]
+        return indent
+
+    def enclosingBlock(self, begin, end):
+        """
+        The innermost complete element laid out as a block which contains
+        begin to end, as (begin, end, indent, token), or None if there
+        isn't one
+        """
+        best = None
+        for span in self.spans:
+            if span[0] <= begin and end <= span[1] and not self.laidOutInline(span[2]):
+                if best is None or span[0] > best[0]:
+                    best = span
+        if best is None:
+            return None
+        return best[0], best[1], self.indentOf(best[2]), best[2]
+
+
+def _findingOrder(finding):
+    return finding['line'], finding['column']
+
+
+class HGLint():
+
+    """
+    HGLint reports problems in html from the parsed elements alone, nothing
+    is laid out or rendered. Each finding is a dict:
+        {'line': 12, 'column': 5, 'rule': 'img-alt', 'name': 'img', 'message': 'img has no alt'}
+    with the line and column, both from 1, of the tag it's about. The
+    img, width and Outlook rules are the html_email fixes HGElement makes
+    when it renders. The rest come from how tags pair up and from comments.
+    lint() returns findings in source order. feed() and close() each
+    return theirs in source order, but the unclosed tags close() reports
+    can be anywhere in the document.
+    Usage:
+        findings = HGLint(settings).lint(html)
+    or a chunk at a time:
+        lint = HGLint(settings)
+        for chunk in chunks:
+            findings.extend(lint.feed(chunk))
+        findings.extend(lint.close())
+    """
+
+    # rule names, for filtering findings
+    rules = (
+        'img-alt',
+        'movable-ink-alt',
+        'img-border',
+        'px-dimension',
+        'outlook-width',
+        'extra-closing-tag',
+        'mismatched-closing-tag',
+        'unclosed-tag',
+        'unrecognized-conditional',
+        )
+    # comments that look like they were meant to be conditionals
+    conditional_like_pat = re.compile(r'\[\s*if\b|\bendif\s*\]', re.IGNORECASE)
+    css_width_pat = re.compile(r'(?:^|;)\s*width\s*:', re.IGNORECASE)
+
+    def __init__(self, settings):
+        self.config = compiledSettings(settings)
+        self.parser = parserClass(self.config)(self.config, '', stream=True)
+        self.stack = self.parser.stack
+        self.stack.getpos = self.parser.getpos
+        # stray end tags are findings, not warnings
+        self.stack.findings = []
+
+    def lint(self, content):
+        findings = self.feed(content) + self.close()
+        findings.sort(key=_findingOrder)
+        return findings
+
+    def feed(self, chunk):
+        self.parser.feed(chunk)
+        return self.findings()
+
+    def close(self):
+        self.parser.close()
+        findings = self.findings()
+        for element in self.stack.ancestors:
+            findings.append(self.finding(element, 'unclosed-tag', '<{}> is never closed'.format(element.name)))
+        self.stack.ancestors = []
+        findings.sort(key=_findingOrder)
+        return findings
+
+    def findings(self):
+        # findings for the elements parsed since the last call, in source order
+        findings = []
+        for element in self.stack.takeElements():
+            findings.extend(self.check(element))
+        for rule, element, message in self.stack.findings:
+            findings.append(self.finding(element, rule, message))
+        del self.stack.findings[:]
+        findings.sort(key=_findingOrder)
+        return findings
+
+    def finding(self, element, rule, message):
+        line, offset = element.position
+        return {'line': line, 'column': offset + 1, 'rule': rule, 'name': element.name, 'message': message}
+
+    def check(self, element):
+        kind = element.kind
+        if kind == 'comment':
+            if element.name == 'plain' and self.conditional_like_pat.search(element.content):
+                return [self.finding(element, 'unrecognized-conditional',
+                                     'comment looks like a conditional but is not one: {!r}'.format(
+                                         element.content.strip()[:40]))]
+            return []
+        if kind != 'starttag' and kind != 'startendtag':
+            return []
+        config = self.config
+        attributes = element.attributes
+        name = element.name
+        findings = []
+        for attr in ('width', 'height'):
+            if attributes.get(attr) and attributes[attr].endswith('px'):
+                findings.append(self.finding(element, 'px-dimension',
+                                             '{}="{}" has px, html {} is in pixels'.format(attr, attributes[attr], attr)))
+        if not config.is_email:
+            return findings
+        if name == 'img':
+            src = attributes.get('src')
+            if src and config.movable_ink_pat.search(src) and not attributes.get('alt'):
+                findings.append(self.finding(element, 'movable-ink-alt', 'Movable Ink img has no alt text'))
+            elif 'alt' not in attributes:
+                findings.append(self.finding(element, 'img-alt', 'img has no alt'))
+            if not attributes.get('border'):
+                findings.append(self.finding(element, 'img-border', 'img has no border'))
+        width = attributes.get('width')
+        if width and (not width.endswith('%') or config.merge_percent_width):
+            if not self.css_width_pat.search(attributes.get('style') or ''):
+                findings.append(self.finding(element, 'outlook-width',
+                                             'width="{}" has no inline css width for Outlook at 120dpi'.format(width)))
+        return findings
+
+
+def groomRegions(settings, raw_content, regions):
+    """
+    Groom only the parts of raw_content the (begin, end) regions fall in,
+    each grown to its enclosing block element and from there to whole
+    lines. Returns sorted, non-overlapping (begin, end, groomed) to replace,
+    which covers the whole document if a region has no enclosing block.
+    """
+    config = compiledSettings(settings)
+    scanner = HGScanner(config, raw_content)
+    break_unit = config.break_unit
+    expanded = []
+    for begin, end in regions:
+        block = scanner.enclosingBlock(min(begin, end), max(begin, end))
+        if block is None:
+            return [(0, len(raw_content), HtmlGroomer(config, raw_content).getGroomed())]
+        expanded.append(block)
+    replacements = []
+    for begin, end, indent, token in sorted(set(expanded)):
+        if replacements and begin < replacements[-1][1]:
+            # nested in a block we already groom
+            continue
+        groomer = HtmlGroomer(config, raw_content[begin:end], indent, raw_content)
+        groomed = groomer.getGroomed()
+        # take over the indent in front of the block, or start a new line
+        # the way a full groom does, which drops the space before it
+        line_start = raw_content.rfind('\n', 0, begin) + 1
+        before = raw_content[line_start:begin]
+        if before.strip():
+            groomed = break_unit + groomed
+            begin = line_start + len(before.rstrip())
+        else:
+            begin = line_start
+        # what follows on the same line stays there unless a full groom
+        # breaks after the endtag, which is inline and followed by
+        # something inline more often than not
+        line_end = raw_content.find('\n', end)
+        if line_end < 0:
+            line_end = len(raw_content)
+        after = raw_content[end:line_end]
+        if after.strip():
+            breaks, next_indent = scanner.breaksAfter(token)
+            if breaks:
+                groomed = groomed + break_unit + groomer.parser.stack.indent_unit * next_indent
+                end += len(after) - len(after.lstrip())
+        replacements.append((begin, end, groomed))
+    return replacements
+
+
+def splitLines(text):
+    """
+    Lines of text with their newlines kept, so they join back to text
+    """
+    lines = text.split('\n')
+    last = lines.pop()
+    lines = [line + '\n' for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+def lineChanges(old_lines, new_lines):
+    """
+    (old_begin, old_end, new_begin, new_end) line ranges that differ. The
+    common head and tail are matched directly so the matcher only sees
+    the middle, which is all a small edit leaves.
+    """
+    limit = min(len(old_lines), len(new_lines))
+    head = 0
+    while head < limit and old_lines[head] == new_lines[head]:
+        head += 1
+    limit -= head
+    tail = 0
+    while tail < limit and old_lines[-1 - tail] == new_lines[-1 - tail]:
+        tail += 1
+    old_middle = old_lines[head:len(old_lines) - tail]
+    new_middle = new_lines[head:len(new_lines) - tail]
+    if not old_middle or not new_middle:
+        if old_middle or new_middle:
+            return [(head, head + len(old_middle), head, head + len(new_middle))]
+        return []
+    import difflib
+    matcher = difflib.SequenceMatcher(None, old_middle, new_middle, autojunk=False)
+    return [(head + i1, head + i2, head + j1, head + j2)
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != 'equal']
+
+
+def diffHunks(old, new):
+    """
+    Sorted, non-overlapping (begin, end, replacement) character ranges of
+    old that turn it into new, each covering whole lines
+    """
+    old_lines = splitLines(old)
+    new_lines = splitLines(new)
+    offsets = [0]
+    for line in old_lines:
+        offsets.append(offsets[-1] + len(line))
+    return [(offsets[i1], offsets[i2], ''.join(new_lines[j1:j2]))
+            for i1, i2, j1, j2 in lineChanges(old_lines, new_lines)]
+
+
+def unifiedDiff(old, new, path='', context=3):
+    """
+    The changes from old to new as a unified diff, empty if there are none
+    """
+    old_lines = splitLines(old)
+    new_lines = splitLines(new)
+    changes = lineChanges(old_lines, new_lines)
+    if not changes:
+        return ''
+    # changes closer than twice the context share a hunk
+    groups = [[changes[0]]]
+    for change in changes[1:]:
+        if change[0] - groups[-1][-1][1] <= 2 * context:
+            groups[-1].append(change)
+        else:
+            groups.append([change])
+    out = ['--- a/{}\n'.format(path), '+++ b/{}\n'.format(path)]
+
+    def emit(prefix, lines):
+        for line in lines:
+            out.append(prefix + line)
+            if not line.endswith('\n'):
+                out.append('\n\\ No newline at end of file\n')
+
+    def span(begin, end):
+        if end - begin == 1:
+            return str(begin + 1)
+        return '{},{}'.format(begin + 1 if end > begin else begin, end - begin)
+
+    for group in groups:
+        old_begin = max(group[0][0] - context, 0)
+        new_begin = group[0][2] - (group[0][0] - old_begin)
+        old_end = min(group[-1][1] + context, len(old_lines))
+        new_end = group[-1][3] + (old_end - group[-1][1])
+        out.append('@@ -{} +{} @@\n'.format(span(old_begin, old_end), span(new_begin, new_end)))
+        at = old_begin
+        for i1, i2, j1, j2 in group:
+            emit(' ', old_lines[at:i1])
+            emit('-', old_lines[i1:i2])
+            emit('+', new_lines[j1:j2])
+            at = i2
+        emit(' ', old_lines[at:old_end])
+    return ''.join(out)
+
+def firstDifference(settings, raw_content, chunk_size=16384):
+    """
+    Check raw_content is groomed already without grooming all of it: the
+    groomed fragments are compared with it as they come and grooming stops
+    at the first difference. None if grooming would change nothing,
+    otherwise (line, current, groomed) as lineDifference() gives them.
+    """
+    groomer = HtmlGroomer(settings, document=raw_content)
+    chunks = (raw_content[begin:begin + chunk_size] for begin in range(0, len(raw_content), chunk_size))
+    fragments = groomer.iterGroomed(chunks)
+    at = 0
+    for fragment in fragments:
+        if not raw_content.startswith(fragment, at):
+            break
+        at += len(fragment)
+    else:
+        if at == len(raw_content):
+            return None
+        fragment = ''
+    # where the groomed text parts from raw_content
+    tail = raw_content[at:at + len(fragment)]
+    same = 0
+    while same < len(fragment) and same < len(tail) and fragment[same] == tail[same]:
+        same += 1
+    differs = at + same
+    line_begin = raw_content.rfind('\n', 0, differs) + 1
+    line_end = raw_content.find('\n', differs)
+    current = raw_content[line_begin:line_end + 1 if line_end >= 0 else len(raw_content)]
+    # enough groomed text to finish its line
+    groomed = raw_content[line_begin:at] + fragment[max(line_begin - at, 0):]
+    for fragment in fragments:
+        if '\n' in groomed:
+            break
+        groomed += fragment
+    groomed_end = groomed.find('\n')
+    if groomed_end >= 0:
+        groomed = groomed[:groomed_end + 1]
+    return raw_content.count('\n', 0, differs) + 1, current, groomed
+
+
+def budgetMessage(size, budget):
+    # output size against the byte_budget setting, for status lines
+    if not budget:
+        return '{:,} bytes'.format(size)
+    return '{:,} bytes, {:.0f}% of the {:,} byte budget{}'.format(
+        size, 100.0 * size / budget, budget, ', over' if size > budget else '')
+
+
+def lineDifference(old, new):
+    """
+    None if old and new are the same, otherwise (line, old, new) for the
+    line they part on, numbered from 1. The lines keep their newlines, so
+    a difference in the line endings alone still shows.
+    """
+    if old == new:
+        return None
+    old_lines = splitLines(old)
+    new_lines = splitLines(new)
+    for line, (current, groomed) in enumerate(zip(old_lines, new_lines)):
+        if current != groomed:
+            return line + 1, current, groomed
+    # one runs on past the other
+    line = min(len(old_lines), len(new_lines))
+    return (line + 1, old_lines[line] if line < len(old_lines) else '',
+            new_lines[line] if line < len(new_lines) else '')
+
+
+# strings match first so anything inside them is left alone
+settings_comment_pat = re.compile(r'(?P<string>"(?:\\.|[^"\\])*")|//[^\n]*|/\*.*?\*/', re.DOTALL)
+settings_comma_pat = re.compile(r'(?P<string>"(?:\\.|[^"\\])*")|,(?P<close>\s*[\]}])')
+
+
+def loadSettings(path=None, overrides=None):
+    """
+    Load a .sublime-settings file outside of Sublime Text: strip the
+    comments and trailing commas it allows and parse what's left as json.
+    overrides is a dict of values to set on top.
+    """
+    import json
+    if path is None:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'HtmlGroomer.sublime-settings')
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+    text = settings_comment_pat.sub(lambda m: m.group('string') or '', text)
+    text = settings_comma_pat.sub(lambda m: m.group('string') or m.group('close'), text)
+    settings = json.loads(text)
+    if overrides:
+        settings.update(overrides)
+    return settings
+
+
+def writeAtomic(path, content):
+    # write next to the target and rename so readers never see half a file
+    import tempfile
+    folder = os.path.dirname(os.path.abspath(path))
+    handle, temp = tempfile.mkstemp(dir=folder, prefix='.html_groomer-', suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'w', encoding='utf-8', newline='') as f:
+            f.write(content)
+        # mkstemp makes the file 0600, keep the mode a plain open() would give
+        if os.path.exists(path):
+            import shutil
+            shutil.copymode(path, temp)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temp, 0o666 & ~umask)
+        os.replace(temp, path)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+if __name__ == '__main__':
+    # the command line lives in html_groomer_cli, this module is the engine
+    from html_groomer_cli import main
+    sys.exit(main())
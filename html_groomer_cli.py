@@ -0,0 +1,866 @@
+"""
+
+HTMLGroomer command line
+
+Grooms files in parallel, and runs and talks to a grooming server.
+html_groomer is the engine, this is everything around it that reads
+arguments, walks directories and opens sockets, so the Sublime plugin
+never loads it.
+
+Usage:
+    python -m html_groomer templates/ --check
+    python -m html_groomer --serve /tmp/html_groomer.sock --jobs 4
+    client = HGClient('/tmp/html_groomer.sock')
+
+"""
+
+import sys
+import os
+import time
+import functools
+import logging
+from collections import deque
+
+try:
+    from .html_groomer import (HGCache, HGConfig, HGLint, HGMemo, HGStats, HtmlGroomer, _findingOrder,
+                               budgetMessage, firstDifference, lineDifference, loadSettings, setTracing,
+                               unifiedDiff, writeAtomic)
+except (ImportError, SystemError):
+    from html_groomer import (HGCache, HGConfig, HGLint, HGMemo, HGStats, HtmlGroomer, _findingOrder,
+                              budgetMessage, firstDifference, lineDifference, loadSettings, setTracing,
+                              unifiedDiff, writeAtomic)
+
+
+def findHtmlFiles(paths, extensions=('.htm', '.html')):
+    """
+    Expand files, directories and globs into (source, relative) pairs.
+    relative is the path to use under an output directory: the path below
+    a directory, or below the part of a glob before its first wildcard.
+    """
+    import glob
+    found = []
+    seen = set()
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(extensions):
+                        source = os.path.join(root, name)
+                        found.append((source, os.path.relpath(source, path)))
+        elif os.path.isfile(path):
+            found.append((path, os.path.basename(path)))
+        else:
+            # build/**/*.htm keeps a/index.htm and b/index.htm apart
+            parts = path.replace(os.sep, '/').split('/')
+            fixed = 0
+            while fixed < len(parts) - 1 and not glob.has_magic(parts[fixed]):
+                fixed += 1
+            base = '/'.join(parts[:fixed]) or os.curdir
+            for source in sorted(glob.glob(path, recursive=True)):
+                if os.path.isfile(source):
+                    found.append((source, os.path.relpath(source, base)))
+    unique = []
+    for source, relative in found:
+        key = os.path.abspath(source)
+        if key not in seen:
+            seen.add(key)
+            unique.append((source, relative))
+    return unique
+
+
+_worker_config = None
+_worker_cache = None
+_worker_stats = False
+
+
+def _initWorker(settings, verbose=False, cache_path=None, cache_bytes=None, stats=False, layout_jobs=None):
+    # compile the settings once per worker process
+    global _worker_config, _worker_cache, _worker_stats, _worker_layout_jobs
+    _worker_config = HGConfig(settings)
+    _worker_stats = stats
+    _worker_layout_jobs = layout_jobs
+    if cache_path:
+        _worker_cache = HGCache(path=cache_path, max_disk_bytes=cache_bytes)
+    else:
+        _worker_cache = None
+    setTracing(verbose)
+
+
+def _lintTask(task, chunk_size=65536):
+    # lint a file a chunk at a time, for keep 'lint'
+    source, destination, keep = task
+    started = time.perf_counter()
+    size = 0
+    try:
+        lint = HGLint(_worker_config)
+        findings = []
+        with open(source, encoding='utf-8', newline='') as f:
+            for chunk in iter(functools.partial(f.read, chunk_size), ''):
+                size += len(chunk.encode('utf-8'))
+                findings.extend(lint.feed(chunk))
+        findings.extend(lint.close())
+        findings.sort(key=_findingOrder)
+        error = None
+    except Exception as e:
+        findings = []
+        error = '{}: {}'.format(type(e).__name__, e)
+    return {
+        'path': source,
+        'changed': False,
+        'cached': False,
+        'seconds': time.perf_counter() - started,
+        'bytes_in': size,
+        'bytes_out': None,
+        'groomed': None,
+        'diff': None,
+        'difference': None,
+        'findings': findings,
+        'stats': None,
+        'error': error,
+        }
+
+
+def _groomTask(task):
+    source, destination, keep = task
+    if keep == 'lint':
+        return _lintTask(task)
+    started = time.perf_counter()
+    stats = None
+    difference = None
+    try:
+        with open(source, encoding='utf-8', newline='') as f:
+            raw_content = f.read()
+        if keep == 'check' and not _worker_stats and not _worker_cache:
+            # stop at the first difference instead of grooming it all
+            difference = firstDifference(_worker_config, raw_content)
+            # nothing past the difference was groomed, so there's no size
+            groomed = None
+            cached = False
+        elif _worker_stats:
+            # a cached result would have nothing to measure
+            stats = HGStats()
+            groomed = HtmlGroomer(_worker_config, raw_content, stats=stats,
+                                  layout_jobs=_worker_layout_jobs).getGroomed()
+            cached = False
+        elif _worker_cache:
+            hits = _worker_cache.hits
+            groomed = _worker_cache.getGroomed(_worker_config, raw_content)
+            cached = _worker_cache.hits > hits
+        else:
+            groomed = HtmlGroomer(_worker_config, raw_content, layout_jobs=_worker_layout_jobs).getGroomed()
+            cached = False
+        if keep == 'check' and groomed is not None:
+            difference = lineDifference(raw_content, groomed)
+        changed = difference is not None if groomed is None else groomed != raw_content
+        if destination and (changed or destination != source):
+            writeAtomic(destination, groomed)
+        error = None
+    except Exception as e:
+        raw_content = groomed = ''
+        changed = cached = False
+        difference = None
+        error = '{}: {}'.format(type(e).__name__, e)
+    return {
+        'path': source,
+        'changed': changed,
+        'cached': cached,
+        'seconds': time.perf_counter() - started,
+        'bytes_in': len(raw_content.encode('utf-8')),
+        'bytes_out': len(groomed.encode('utf-8')) if groomed is not None else None,
+        'groomed': groomed if keep is True else None,
+        'diff': unifiedDiff(raw_content, groomed, source) if keep == 'diff' else None,
+        'difference': difference,
+        'findings': None,
+        'stats': stats.summary() if stats is not None else None,
+        'error': error,
+        }
+
+
+def groomFiles(settings, tasks, jobs=None, chunksize=None, verbose=False, cache_path=None, cache_bytes=256 * 1024 * 1024,
+               stats=False, layout_jobs=None):
+    """
+    Groom (source, destination, keep) tasks across a process pool and
+    yield a result dict per file as they finish. destination None means
+    don't write, keep True returns the groomed text in the result,
+    keep 'diff' a unified diff against the source and keep 'check' the
+    firstDifference() of the source. keep 'lint' adds the HGLint findings
+    of the source and grooms nothing. With a
+    cache_path the workers share an HGCache directory. stats adds an
+    HGStats summary to each result and bypasses the cache. layout_jobs
+    above 1 grooms one file at a time, laying each out on that many
+    processes, for a few huge documents.
+    """
+    init_args = (settings, verbose, cache_path, cache_bytes, stats, layout_jobs)
+    import multiprocessing
+    if layout_jobs and layout_jobs > 1:
+        # pool workers can't start pools of their own
+        jobs = 1
+    if not jobs:
+        jobs = multiprocessing.cpu_count()
+    jobs = min(jobs, max(len(tasks), 1))
+    if jobs == 1:
+        _initWorker(*init_args)
+        for task in tasks:
+            yield _groomTask(task)
+        return
+    if not chunksize:
+        # big enough to amortize dispatch, small enough to balance the load
+        chunksize = max(1, min(32, len(tasks) // (jobs * 4)))
+    pool = multiprocessing.Pool(jobs, _initWorker, init_args)
+    try:
+        for result in pool.imap_unordered(_groomTask, tasks, chunksize):
+            yield result
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+_serve_settings = None
+_serve_configs = None
+
+
+def _initServeWorker(settings):
+    # settings are compiled on first use, once per distinct request settings
+    global _serve_settings, _serve_configs
+    _serve_settings = settings
+    _serve_configs = HGMemo(64)
+
+
+def _serveTask(groomer_type, overrides, content):
+    # overrides is canonical json, so equal request settings share a config
+    key = (groomer_type, overrides)
+    config = _serve_configs.get(key)
+    if config is None:
+        import json
+        values = dict(_serve_settings)
+        values.update(json.loads(overrides))
+        values['groomer_type'] = groomer_type
+        config = HGConfig(values)
+        _serve_configs.put(key, config)
+    return HtmlGroomer(config, content).getGroomed()
+
+
+def parseAddress(address):
+    """
+    ('unix', path) for a socket path, or ('tcp', (host, port)) for
+    host:port, :port or a bare port, which listen on localhost. The
+    server has no authentication, so hosts other than localhost and
+    loopback addresses are a ValueError.
+    """
+    import ipaddress
+    if os.sep in address or address.endswith('.sock'):
+        return 'unix', address
+    host, sep, port = address.rpartition(':')
+    host = host.strip('[]') or '127.0.0.1'
+    if host != 'localhost':
+        try:
+            loopback = ipaddress.ip_address(host).is_loopback
+        except ValueError:
+            loopback = False
+        if not loopback:
+            raise ValueError('{} is not a loopback address, the server only listens on localhost'.format(host))
+    return 'tcp', (host, int(port))
+
+
+class HGServer():
+
+    """
+    HGServer grooms html sent over a Unix socket or a localhost port, on a
+    pool of worker processes started and warmed up front. Requests and
+    replies are single lines of json, and replies carry the id of their
+    request, so a client can pipeline:
+        {"id": 1, "content": "<p>..", "groomer_type": "html_email", "settings": {"compact": true}}
+        {"id": 1, "groomed": "<p>..", "changed": true, "ms": 1.2}
+        {"id": 2, "op": "stats"}
+    At most max_pending requests are grooming or queued for the pool.
+    Past that the server stops reading from the connections that have more
+    to send until a groom finishes. A request still running after timeout
+    seconds is answered with an error, but it keeps its pool slot until
+    its worker is done.
+    Usage:
+        HGServer(loadSettings(), jobs=4).serveForever('/tmp/html_groomer.sock')
+    """
+
+    logger = logging.getLogger('HGServer')
+
+    def __init__(self, settings, jobs=None, max_pending=None, timeout=30.0, max_request_bytes=64 * 1024 * 1024):
+        import multiprocessing
+        self.settings = dict(settings)
+        self.jobs = jobs or multiprocessing.cpu_count()
+        self.max_pending = max_pending or self.jobs * 4
+        self.timeout = timeout
+        self.max_request_bytes = max_request_bytes
+        self.pending = 0
+        # connections paused until a pool slot frees up
+        self.waiting = deque()
+        self.connections = 0
+        self.counts = dict.fromkeys(('requests', 'groomed', 'errors', 'timeouts', 'chars_in', 'chars_out'), 0)
+        self.latencies = deque(maxlen=1024)
+        self.started = time.time()
+        self.loop = None
+        self.pool = None
+
+    def start(self, address):
+        import asyncio
+        import concurrent.futures
+        self.loop = asyncio.new_event_loop()
+        self.pool = concurrent.futures.ProcessPoolExecutor(self.jobs, initializer=_initServeWorker,
+                                                           initargs=(self.settings,))
+        # start every worker and compile the default config before the first request
+        warm = [self.pool.submit(_serveTask, groomer_type, '{}', '<p>warm</p>')
+                for j in range(self.jobs) for groomer_type in ('html', 'html_email')]
+        concurrent.futures.wait(warm)
+        kind, where = parseAddress(address)
+        if kind == 'unix':
+            if os.path.exists(where):
+                os.unlink(where)
+            server = self.loop.run_until_complete(self.loop.create_unix_server(self.connection, where))
+            os.chmod(where, 0o600)
+        else:
+            server = self.loop.run_until_complete(self.loop.create_server(self.connection, *where))
+        self.logger.info('grooming on %s with %s workers', address, self.jobs)
+        return server
+
+    def serveForever(self, address):
+        server = self.start(address)
+        try:
+            self.loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            self.loop.run_until_complete(server.wait_closed())
+            self.pool.shutdown(cancel_futures=True)
+            self.loop.close()
+            kind, where = parseAddress(address)
+            if kind == 'unix' and os.path.exists(where):
+                os.unlink(where)
+
+    def connection(self):
+        return HGConnection(self)
+
+    def handle(self, connection, line):
+        import json
+        self.counts['requests'] += 1
+        try:
+            request = json.loads(line.decode('utf-8'))
+            if not isinstance(request, dict):
+                raise ValueError('a request is a json object')
+        except ValueError as e:
+            self.counts['errors'] += 1
+            connection.reply({'id': None, 'error': 'bad request: {}'.format(e)})
+            return
+        op = request.get('op', 'groom')
+        if op == 'stats':
+            connection.reply({'id': request.get('id'), 'stats': self.stats()})
+        elif op == 'ping':
+            connection.reply({'id': request.get('id'), 'pong': True})
+        elif op == 'groom':
+            self.groom(connection, request)
+        else:
+            self.counts['errors'] += 1
+            connection.reply({'id': request.get('id'), 'error': 'unknown op: {}'.format(op)})
+
+    def groom(self, connection, request):
+        import json
+        content = request.get('content')
+        groomer_type = request.get('groomer_type', 'html')
+        overrides = request.get('settings') or {}
+        if not isinstance(content, str) or groomer_type not in ('html', 'html_email') or not isinstance(overrides, dict):
+            self.counts['errors'] += 1
+            connection.reply({'id': request.get('id'), 'error': 'bad request: needs content, a groomer_type '
+                              'of html or html_email and settings as an object'})
+            return
+        job = {'id': request.get('id'), 'connection': connection, 'content': content,
+               'started': time.perf_counter(), 'answered': False}
+        self.pending += 1
+        job['future'] = self.pool.submit(_serveTask, groomer_type, json.dumps(overrides, sort_keys=True), content)
+        job['timer'] = self.loop.call_later(self.timeout, self.expire, job)
+        # pool threads finish the future, the loop does the rest
+        job['future'].add_done_callback(lambda future: self.loop.call_soon_threadsafe(self.finish, job))
+
+    def expire(self, job):
+        if job['answered']:
+            return
+        job['answered'] = True
+        job['future'].cancel()
+        self.counts['timeouts'] += 1
+        job['connection'].reply({'id': job['id'], 'error': 'timed out after {}s'.format(self.timeout)})
+
+    def finish(self, job):
+        self.pending -= 1
+        job['timer'].cancel()
+        if not job['answered']:
+            job['answered'] = True
+            future = job['future']
+            seconds = time.perf_counter() - job['started']
+            try:
+                groomed = future.result()
+            except Exception as e:
+                self.counts['errors'] += 1
+                job['connection'].reply({'id': job['id'], 'error': '{}: {}'.format(type(e).__name__, e)})
+            else:
+                self.counts['groomed'] += 1
+                self.counts['chars_in'] += len(job['content'])
+                self.counts['chars_out'] += len(groomed)
+                self.latencies.append(seconds)
+                job['connection'].reply({'id': job['id'], 'groomed': groomed, 'changed': groomed != job['content'],
+                                         'ms': round(seconds * 1000, 3)})
+        # a slot is free, let paused connections send more
+        while self.waiting and self.pending < self.max_pending:
+            self.waiting.popleft().drain()
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            return round(latencies[min(int(p * len(latencies)), len(latencies) - 1)] * 1000, 3) if latencies else None
+
+        stats = dict(self.counts)
+        stats.update({
+            'uptime': round(time.time() - self.started, 3),
+            'jobs': self.jobs,
+            'max_pending': self.max_pending,
+            'pending': self.pending,
+            'waiting': len(self.waiting),
+            'connections': self.connections,
+            'ms_p50': percentile(0.5),
+            'ms_p99': percentile(0.99),
+            })
+        return stats
+
+
+class HGConnection():
+
+    """
+    One client of an HGServer, as an asyncio protocol: splits what arrives
+    into request lines and hands them on while the pool has room
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.buffer = bytearray()
+        self.lines = deque()
+        self.paused = False
+        # lines handed to the server and replies written, to close after eof
+        self.handled = 0
+        self.replied = 0
+        self.eof = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server.connections += 1
+
+    def connection_lost(self, exc):
+        self.server.connections -= 1
+        self.lines.clear()
+
+    def data_received(self, data):
+        self.buffer.extend(data)
+        limit = self.server.max_request_bytes
+        begin = 0
+        while True:
+            end = self.buffer.find(b'\n', begin)
+            # a whole request line over the limit, or the start of one
+            over = (end if end >= 0 else len(self.buffer)) - begin > limit
+            if end < 0 or over:
+                break
+            if end > begin:
+                self.lines.append(bytes(self.buffer[begin:end]))
+            begin = end + 1
+        del self.buffer[:begin]
+        if over:
+            self.reply({'id': None, 'error': 'request over {} bytes'.format(limit)})
+            self.transport.close()
+            return
+        self.drain()
+
+    def eof_received(self):
+        # replies still owed go out before the transport closes
+        self.eof = True
+        return bool(self.lines) or self.handled > self.replied
+
+    def drain(self):
+        server = self.server
+        while self.lines and server.pending < server.max_pending:
+            self.handled += 1
+            server.handle(self, self.lines.popleft())
+        if self.lines and not self.paused:
+            self.paused = True
+            self.transport.pause_reading()
+            server.waiting.append(self)
+        elif not self.lines and self.paused:
+            self.paused = False
+            self.transport.resume_reading()
+        elif self.lines:
+            server.waiting.append(self)
+
+    def reply(self, message):
+        import json
+        self.replied += 1
+        if not self.transport.is_closing():
+            self.transport.write(json.dumps(message).encode('utf-8') + b'\n')
+            if self.eof and not self.lines and self.handled <= self.replied:
+                self.transport.close()
+
+
+class HGClient():
+
+    """
+    Blocking client for an HGServer. Keep one open for many documents, a
+    groom then costs a round trip rather than a process start:
+        client = HGClient('/tmp/html_groomer.sock')
+        groomed = client.groom(html, 'html_email', {'compact': True})
+    """
+
+    def __init__(self, address, timeout=None):
+        import socket
+        kind, where = parseAddress(address)
+        if kind == 'unix':
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.socket = socket.socket(socket.AF_INET6 if ':' in where[0] else socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.settimeout(timeout)
+        self.socket.connect(where)
+        self.reader = self.socket.makefile('rb')
+        self.next_id = 0
+        # replies that came back ahead of the one waited for
+        self.early = {}
+
+    def send(self, message):
+        import json
+        self.next_id += 1
+        message['id'] = self.next_id
+        self.socket.sendall(json.dumps(message).encode('utf-8') + b'\n')
+        return self.next_id
+
+    def receive(self, request_id):
+        import json
+        while request_id not in self.early:
+            line = self.reader.readline()
+            if not line:
+                raise IOError('html groomer server closed the connection')
+            reply = json.loads(line.decode('utf-8'))
+            self.early[reply.get('id')] = reply
+        return self.early.pop(request_id)
+
+    def request(self, message):
+        reply = self.receive(self.send(message))
+        if 'error' in reply:
+            raise RuntimeError(reply['error'])
+        return reply
+
+    def groom(self, content, groomer_type='html', settings=None):
+        return self.request({'content': content, 'groomer_type': groomer_type, 'settings': settings or {}})['groomed']
+
+    def groomAll(self, contents, groomer_type='html', settings=None, window=16):
+        """
+        Yield a reply dict per content, in order, keeping up to window
+        requests in flight so the server's workers stay busy
+        """
+        sent = deque()
+        for content in contents:
+            sent.append(self.send({'content': content, 'groomer_type': groomer_type, 'settings': settings or {}}))
+            if len(sent) >= window:
+                yield self.receive(sent.popleft())
+        while sent:
+            yield self.receive(sent.popleft())
+
+    def stats(self):
+        return self.request({'op': 'stats'})['stats']
+
+    def close(self):
+        self.reader.close()
+        self.socket.close()
+
+
+def groomRemoteFiles(address, groomer_type, overrides, tasks, window=16):
+    """
+    groomFiles with an HGServer doing the grooming, over one connection.
+    The results come in task order and check compares whole documents.
+    """
+    client = HGClient(address)
+    try:
+        contents = []
+        for source, destination, keep in tasks:
+            with open(source, encoding='utf-8', newline='') as f:
+                contents.append(f.read())
+        started = time.perf_counter()
+        replies = client.groomAll(contents, groomer_type, overrides, window)
+        for (source, destination, keep), raw_content, reply in zip(tasks, contents, replies):
+            error = reply.get('error')
+            groomed = reply.get('groomed') or ''
+            changed = not error and groomed != raw_content
+            difference = lineDifference(raw_content, groomed) if keep == 'check' and changed else None
+            if destination and not error and (changed or destination != source):
+                writeAtomic(destination, groomed)
+            yield {
+                'path': source,
+                'changed': changed,
+                'cached': False,
+                'seconds': time.perf_counter() - started,
+                'bytes_in': len(raw_content.encode('utf-8')),
+                'bytes_out': len(groomed.encode('utf-8')),
+                'groomed': groomed if keep is True else None,
+                'diff': unifiedDiff(raw_content, groomed, source) if keep == 'diff' and not error else None,
+                'difference': difference,
+                'findings': None,
+                'stats': None,
+                'error': error,
+                }
+            started = time.perf_counter()
+    finally:
+        client.close()
+
+
+def parseOverride(text):
+    import json
+    key, sep, value = text.partition('=')
+    if not sep:
+        raise ValueError('expected key=value: {}'.format(text))
+    try:
+        return key.strip(), json.loads(value)
+    except ValueError:
+        return key.strip(), value
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog='python -m html_groomer',
+        description='Groom html files with the HtmlGroomer settings.',
+        )
+    parser.add_argument('paths', nargs='*', help='files, directories or globs')
+    parser.add_argument('-t', '--type', dest='groomer_type', default='html', choices=('html', 'html_email'))
+    parser.add_argument('-s', '--settings', help='settings file, default HtmlGroomer.sublime-settings')
+    parser.add_argument('-u', '--user-settings', action='append', default=[], help='settings file applied on top, may repeat')
+    parser.add_argument('--set', dest='overrides', action='append', default=[], metavar='KEY=JSON', help='override one setting, may repeat')
+    parser.add_argument('-i', '--in-place', action='store_true', help='write groomed files back in place')
+    parser.add_argument('-o', '--output-dir', help='write groomed files under this directory')
+    parser.add_argument('--compact', action='store_true', help='minimal whitespace, for html email byte budgets')
+    parser.add_argument('--budget', type=int, metavar='BYTES', help='byte budget to report against, default the byte_budget setting')
+    parser.add_argument('--check', action='store_true', help="don't write, exit 1 if any file would change")
+    parser.add_argument('--diff', action='store_true', help="don't write, print a unified diff of the changes")
+    parser.add_argument('--lint', action='store_true', help="don't groom, print problems as path:line:column lines, exit 1 if any")
+    parser.add_argument('--json', action='store_true', help='with --lint, print a json object per problem')
+    parser.add_argument('-e', '--ext', action='append', help='extensions to pick up in directories, default .htm .html')
+    parser.add_argument('-j', '--jobs', type=int, default=0, help='worker processes, default one per cpu')
+    parser.add_argument('--layout-jobs', type=int, default=0, metavar='N',
+                        help='lay out each file on N processes, one file at a time, for huge documents')
+    parser.add_argument('--chunksize', type=int, default=0, help='files handed to a worker at a time')
+    parser.add_argument('--cache', metavar='DIR', help='reuse groomed results stored in this directory')
+    parser.add_argument('--cache-size', type=float, default=256, metavar='MB', help='evict the oldest cached results past this size')
+    parser.add_argument('--slowest', type=int, default=5, help='how many of the slowest files to list')
+    parser.add_argument('--stats', action='store_true', help='time each phase and count what it did, bypasses --cache')
+    parser.add_argument('-q', '--quiet', action='store_true', help='no summary')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log every element')
+    parser.add_argument('--trace', metavar='FILE', help="write each file's element table as json lines, - for stdout")
+    parser.add_argument('--serve', metavar='ADDRESS',
+                        help='run a grooming server on a socket path or [host:]port, with --jobs warm workers')
+    parser.add_argument('--max-pending', type=int, default=0, help='requests the server takes on before it stops reading')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds the server gives a request')
+    parser.add_argument('--server', metavar='ADDRESS', help='groom with the server running on ADDRESS')
+    args = parser.parse_args(argv)
+    logging.basicConfig(format='%(name)s: %(funcName)s: %(message)s')
+    if sum((args.in_place, bool(args.output_dir), args.check or args.diff, bool(args.lint))) > 1:
+        parser.error('use only one of --in-place, --output-dir, --lint and --check or --diff')
+    if args.server and (args.stats or args.cache or args.layout_jobs or args.trace or args.lint):
+        parser.error('--stats, --cache, --layout-jobs, --trace and --lint run locally, not with --server')
+    settings = loadSettings(args.settings)
+    # what the command line changes, which is all a server is sent
+    overrides = {}
+    for path in args.user_settings:
+        overrides.update(loadSettings(path))
+    for override in args.overrides:
+        try:
+            key, value = parseOverride(override)
+        except ValueError as e:
+            parser.error(str(e))
+        overrides[key] = value
+    if args.compact:
+        overrides['compact'] = True
+    if args.budget is not None:
+        overrides['byte_budget'] = args.budget
+    settings.update(overrides)
+    for address in (args.serve, args.server):
+        if address:
+            try:
+                parseAddress(address)
+            except ValueError as e:
+                parser.error(str(e))
+    if args.serve:
+        HGServer.logger.setLevel(logging.INFO)
+        HGServer(settings, args.jobs, args.max_pending, args.timeout).serveForever(args.serve)
+        return 0
+    if not args.paths:
+        parser.error('no paths given')
+    settings['groomer_type'] = args.groomer_type
+
+    extensions = tuple(ext if ext.startswith('.') else '.' + ext for ext in (args.ext or ('htm', 'html')))
+    files = findHtmlFiles(args.paths, extensions)
+    if not files:
+        parser.error('no files found')
+    to_stdout = not (args.in_place or args.output_dir or args.check or args.lint)
+    if args.lint:
+        keep = 'lint'
+    elif args.diff:
+        keep = 'diff'
+    elif args.check:
+        keep = 'check'
+    else:
+        keep = to_stdout
+    tasks = []
+    for source, relative in files:
+        if args.in_place:
+            destination = source
+        elif args.output_dir:
+            destination = os.path.join(args.output_dir, relative)
+        else:
+            destination = None
+        tasks.append((source, destination, keep))
+    if args.output_dir:
+        # two sources named alike from different folders
+        written = {}
+        for source, destination, keep in tasks:
+            key = os.path.normcase(os.path.abspath(destination))
+            if key in written:
+                parser.error('{} and {} would both be written to {}'.format(written[key], source, destination))
+            written[key] = source
+        for destination in written:
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+
+    started = time.perf_counter()
+    results = []
+    by_path = {}
+    cache_bytes = int(args.cache_size * 1024 * 1024)
+    if args.server:
+        groomed_results = groomRemoteFiles(args.server, args.groomer_type, overrides, tasks)
+    else:
+        groomed_results = groomFiles(settings, tasks, args.jobs, args.chunksize, args.verbose, args.cache, cache_bytes,
+                                     args.stats, args.layout_jobs)
+    for result in groomed_results:
+        results.append(result)
+        by_path[result['path']] = result
+        if result['error']:
+            sys.stderr.write('error: {}: {}\n'.format(result['path'], result['error']))
+        elif args.check and result['changed']:
+            sys.stderr.write('would groom: {}\n'.format(result['path']))
+            if result['difference']:
+                line, current, groomed = result['difference']
+                sys.stderr.write('  line {}:\n  - {!r}\n  + {!r}\n'.format(line, current, groomed))
+    elapsed = time.perf_counter() - started
+    if to_stdout or args.diff:
+        # in input order, not the order the pool finished them
+        for source, relative in files:
+            sys.stdout.write(by_path[source]['diff' if args.diff else 'groomed'] or '')
+    if args.lint:
+        writeFindings([by_path[source] for source, relative in files], 'json' if args.json else 'text')
+
+    if not args.quiet:
+        reportThroughput(results, elapsed, args.slowest)
+        if args.lint:
+            reportFindings(results)
+        elif args.compact or args.budget or args.groomer_type == 'html_email':
+            reportBudget(results, int(settings.get('byte_budget') or 0))
+    if args.stats:
+        stats = HGStats()
+        for result in results:
+            if result['stats']:
+                stats.merge(result['stats'])
+        stats.report()
+    if args.trace:
+        writeTrace(settings, files, args.trace)
+    if any(result['error'] for result in results):
+        return 2
+    if args.check and any(result['changed'] for result in results):
+        return 1
+    if args.lint and any(result['findings'] for result in results):
+        return 1
+    return 0
+
+
+def writeFindings(results, form='text', out=None):
+    # path:line:column: rule: message, or a json object per finding
+    import json
+    out = out or sys.stdout
+    for result in results:
+        for finding in result['findings'] or ():
+            if form == 'json':
+                row = dict(finding)
+                row['path'] = result['path']
+                out.write(json.dumps(row) + '\n')
+            else:
+                out.write('{}:{}:{}: {}: {}\n'.format(
+                    result['path'], finding['line'], finding['column'], finding['rule'], finding['message']))
+
+
+def reportFindings(results, out=None):
+    out = out or sys.stderr
+    counts = {}
+    for result in results:
+        for finding in result['findings'] or ():
+            counts[finding['rule']] = counts.get(finding['rule'], 0) + 1
+    files = sum(1 for result in results if result['findings'])
+    out.write('lint: {} findings in {} files{}\n'.format(
+        sum(counts.values()), files,
+        ''.join(', {} {}'.format(counts[rule], rule) for rule in HGLint.rules if rule in counts)))
+
+
+def writeTrace(settings, files, path):
+    # element tables after layout, one json object per element
+    import json
+    config = HGConfig(settings)
+    out = sys.stdout if path == '-' else open(path, 'w', encoding='utf-8')
+    try:
+        for source, relative in files:
+            with open(source, encoding='utf-8', newline='') as f:
+                groomer = HtmlGroomer(config, f.read())
+            groomer.getGroomed()
+            for row in groomer.parser.stack.elementTable():
+                row['path'] = source
+                out.write(json.dumps(row) + '\n')
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+def reportThroughput(results, elapsed, slowest=5, out=None):
+    out = out or sys.stderr
+    count = len(results)
+    megabytes = sum(result['bytes_in'] for result in results) / 1e6
+    changed = sum(1 for result in results if result['changed'])
+    errors = sum(1 for result in results if result['error'])
+    elapsed = max(elapsed, 1e-9)
+    cached = sum(1 for result in results if result.get('cached'))
+    out.write('{} files, {:.2f} MB in {:.2f}s: {:.1f} files/s, {:.2f} MB/s, {} changed, {} errors\n'.format(
+        count, megabytes, elapsed, count / elapsed, megabytes / elapsed, changed, errors))
+    if cached:
+        out.write('cache: {} hits, {} misses\n'.format(cached, count - errors - cached))
+    if slowest:
+        for result in sorted(results, key=lambda r: r['seconds'], reverse=True)[:slowest]:
+            out.write('  {:8.3f}s  {}\n'.format(result['seconds'], result['path']))
+
+
+def reportBudget(results, budget, out=None):
+    # groomed sizes against the byte budget, listing the files over it
+    out = out or sys.stderr
+    # --check stops at the first difference, so it has no groomed sizes
+    sizes = [(result['bytes_out'], result['path']) for result in results
+             if not result['error'] and result['bytes_out'] is not None]
+    if not sizes or not budget:
+        return
+    over = sorted((size for size in sizes if size[0] > budget), reverse=True)
+    out.write('budget: {} of {} files over {:,} bytes, largest {}\n'.format(
+        len(over), len(sizes), budget, budgetMessage(max(sizes)[0], budget)))
+    for size, path in over:
+        out.write('  {:>10,}  {}\n'.format(size, path))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,19 +1,129 @@
 # $Id: html_groomer_plugin.py 222 2017-12-05 14:52:21Z jmcfarren $
 
+import sys
 import sublime
 import sublime_plugin
-from .html_groomer import HtmlGroomer
+from .html_groomer import HtmlGroomer, HGConfig, HGCancelled, HGStats, budgetMessage, groomRegions, diffHunks
+
+
+# the background job running for each view, by view id
+_jobs = {}
+
+
+def reportStats(stats):
+    # shows up in the Sublime console
+    if stats is not None:
+        print('HtmlGroomer stats:')
+        stats.report(sys.stdout)
+
+
+def reportBudget(config, groomed):
+    # the groomed size, against the byte budget for html email
+    if config.compact or config.groomer_type == 'html_email':
+        sublime.status_message('HtmlGroomer: ' + budgetMessage(len(groomed.encode('utf-8')), config.byte_budget))
+
+
+def applyHunks(view, edit, hunks):
+    # replace from the end so earlier offsets stay put
+    for begin, end, replacement in reversed(hunks):
+        view.replace(edit, sublime.Region(begin, end), replacement)
+
+
+class HtmlGroomerJob():
+
+    """
+    Grooms a snapshot of a view off the UI thread
+    """
+
+    def __init__(self, view, config, content, stats=None):
+        self.view = view
+        self.config = config
+        self.content = content
+        self.stats = stats
+        self.change_count = view.change_count()
+        self.cancelled = False
+
+    def start(self):
+        stale = _jobs.get(self.view.id())
+        if stale is not None:
+            stale.cancelled = True
+        _jobs[self.view.id()] = self
+        self.status('HtmlGroomer: grooming')
+        sublime.set_timeout_async(self.groom, 0)
+
+    def groom(self):
+        # apply() calls finish() on the UI thread, anything else has to here
+        applying = False
+        try:
+            groomer = HtmlGroomer(settings=self.config, raw_content=self.content, progress=self.progress, stats=self.stats)
+            groomed = groomer.getGroomed()
+            hunks = diffHunks(self.content, groomed)
+            reportStats(self.stats)
+            sublime.set_timeout(lambda: self.apply(hunks, groomed), 0)
+            applying = True
+        except HGCancelled:
+            pass
+        except Exception as e:
+            message = 'HtmlGroomer: groom failed, {0}: {1}'.format(type(e).__name__, e)
+            print(message)
+            sublime.set_timeout(lambda: sublime.status_message(message), 0)
+            raise
+        finally:
+            if not applying:
+                self.finish()
+
+    def progress(self, phase, done, total):
+        # change_count is safe to call from the async thread
+        if self.cancelled or self.view.change_count() != self.change_count:
+            raise HGCancelled()
+        percent = 100 * done // total if total else 100
+        self.status('HtmlGroomer: {0} {1}%'.format(phase, percent))
+
+    def apply(self, hunks, groomed):
+        if not self.cancelled:
+            self.view.run_command('html_groomer_apply', {'hunks': hunks, 'change_count': self.change_count})
+            reportBudget(self.config, groomed)
+        self.finish()
+
+    def finish(self):
+        if _jobs.get(self.view.id()) is self:
+            del _jobs[self.view.id()]
+            sublime.set_timeout(lambda: self.view.erase_status('html_groomer'), 0)
+
+    def status(self, message):
+        sublime.set_timeout(lambda: self.view.set_status('html_groomer', message), 0)
+
+
+class HtmlGroomerApplyCommand(sublime_plugin.TextCommand):
+
+
+    def run(self, edit, hunks, change_count):
+        # the buffer was edited while grooming, the result is stale
+        if self.view.change_count() != change_count:
+            sublime.status_message('HtmlGroomer: buffer changed, groom discarded')
+            return
+        applyHunks(self.view, edit, hunks)
 
 
 class HtmlGroomerCommand(sublime_plugin.TextCommand):
 
 
-    def run(self, edit, actions=[], groomer_type='html'):
+    def run(self, edit, actions=[], groomer_type='html', selection=False, compact=False):
         groomer_settings = sublime.load_settings('HtmlGroomer.sublime-settings')
         groomer_settings.set('groomer_type', groomer_type)
+        groomer_settings.set('compact', compact)
         user_settings = sublime.load_settings("Preferences.sublime-settings")
         region = sublime.Region(0, self.view.size())
-        groomer = HtmlGroomer(settings=groomer_settings, raw_content=self.view.substr(region))
+        if selection:
+            self.groomSelections(edit, HGConfig(groomer_settings), self.view.substr(region))
+            return
+        content = self.view.substr(region)
+        stats = HGStats() if groomer_settings.get('show_stats') else None
+        if len(content) >= groomer_settings.get('async_threshold', 100000):
+            # settings objects belong to the UI thread, snapshot them here
+            HtmlGroomerJob(self.view, HGConfig(groomer_settings), content, stats).start()
+            return
+        groomer = HtmlGroomer(settings=groomer_settings, raw_content=content, stats=stats)
         # if groomer.parser.stack.convert_indent:
         #     user_tab_size = user_settings.get('tab_size')
         #     if user_tab_size:
@@ -24,4 +134,14 @@ class HtmlGroomerCommand(sublime_plugin.TextCommand):
         #     self.view.run_command('unexpand_tabs')
         #     self.view.settings().set('translate_tabs_to_spaces', False)
         #     self.view.settings().set('tab_size', tab_size)
-        self.view.replace(edit, region, groomer.getGroomed())
\ No newline at end of file
+        # only touch the lines that changed, which keeps undo, folds and
+        # the cursor where they were
+        groomed = groomer.getGroomed()
+        applyHunks(self.view, edit, diffHunks(content, groomed))
+        reportStats(stats)
+        reportBudget(groomer.config, groomed)
+
+    def groomSelections(self, edit, config, content):
+        # each selection grows to its enclosing block element
+        selections = [(sel.begin(), sel.end()) for sel in self.view.sel()]
+        applyHunks(self.view, edit, groomRegions(config, content, selections))
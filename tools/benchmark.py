@@ -0,0 +1,374 @@
+"""
+
+HtmlGroomer benchmark
+
+Grooms seeded synthetic email templates and times each phase separately:
+    parse   HGParser construction, tokenizing and building the elements,
+            with the backend the tokenizer setting names
+    layout  HGStack.groomed_html
+    post    HtmlGroomer.postProcess, the regex passes over the output
+
+Usage:
+    python tools/benchmark.py
+    python tools/benchmark.py --quick --output before.json
+    python tools/benchmark.py --output after.json --compare before.json
+    python tools/benchmark.py --corpus corpus/ --sizes 32768 131072
+    python tools/benchmark.py --tokenizer regex --compare before.json
+    python tools/benchmark.py --layout-jobs 4 --sizes 1048576 4194304
+
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from html_groomer import HGConfig, HtmlGroomer, codeFingerprint, loadSettings, parserClass, tokenizers
+
+
+FONTS = ['Arial, Helvetica, sans-serif', 'Georgia, serif', "'Open Sans', Arial, sans-serif", 'Verdana, sans-serif']
+COLORS = ['#fff', '#000000', '#e5e5e5', '#1a82e2', '#ABC', '#333', '#f4f4f4', '#d9534f']
+STYLE_PROPS = [
+    lambda r: 'font-family:{}'.format(r.choice(FONTS)),
+    lambda r: 'font-size:{}px'.format(r.choice((11, 12, 14, 16, 18, 24))),
+    lambda r: 'line-height:{}px'.format(r.choice((16, 18, 20, 24, 30))),
+    lambda r: 'color:{}'.format(r.choice(COLORS)),
+    lambda r: 'background-color:{}'.format(r.choice(COLORS)),
+    lambda r: 'padding:{0}px {1}px {0}px {1}px'.format(r.choice((0, 5, 10, 20)), r.choice((0, 10, 15, 30))),
+    lambda r: 'margin:0',
+    lambda r: 'text-align:{}'.format(r.choice(('left', 'center', 'right'))),
+    lambda r: 'display:{}'.format(r.choice(('block', 'inline-block', 'none'))),
+    lambda r: 'border:{}px solid {}'.format(r.choice((0, 1, 2)), r.choice(COLORS)),
+    lambda r: 'mso-line-height-rule:exactly',
+    lambda r: 'width:{}'.format(r.choice(('100%', '600px', '50%', '280px'))),
+    ]
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore '
+         'et dolore magna aliqua your order has shipped view in browser unsubscribe &nbsp; &amp; &copy;').split()
+INLINE_TAGS = ['span', 'a', 'b', 'strong', 'em', 'font', 'sup']
+AMPSCRIPT = [
+    '<!-- %%[ SET @first_name = AttributeValue("first_name") ]%% -->',
+    '<!-- %%[ IF @segment == "vip" THEN ]%% -->',
+    '<!-- %%[ ENDIF ]%% -->',
+    '<!-- %%[ SET @url = RedirectTo(CONCAT("http://example.com/?id=", @id)) ]%% -->',
+    ]
+
+
+class TemplateGenerator():
+
+    """
+    Seeded generator of email html. The same seed and options always give
+    the same document.
+        size         characters to grow the body to
+        depth        how deep layout tables nest
+        inline       0 to 1, share of content that is inline markup
+        conditionals chance of wrapping a section in MSO conditionals
+        ampscript    chance of an AMPscript comment before an element
+        styles       style properties on each styled element
+        blocks       style and script blocks in the document
+    """
+
+    def __init__(self, seed=0, size=65536, depth=4, inline=0.5, conditionals=0.2,
+                 ampscript=0.05, styles=4, blocks=2):
+        self.random = random.Random(seed)
+        self.size = size
+        self.depth = depth
+        self.inline = inline
+        self.conditionals = conditionals
+        self.ampscript = ampscript
+        self.styles = styles
+        self.blocks = blocks
+
+    def generate(self):
+        r = self.random
+        out = [
+            '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" '
+            '"http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">\n',
+            '<html xmlns="http://www.w3.org/1999/xhtml"><head>',
+            '<meta http-equiv="Content-Type" content="text/html; charset=utf-8" />',
+            '<meta name="viewport" content="width=device-width, initial-scale=1.0" />',
+            '<title>{}</title>'.format(self.text(4)),
+            ]
+        for b in range(self.blocks):
+            out.append(self.styleBlock() if b % 2 == 0 else self.scriptBlock())
+        out.append('<!--[if gte mso 9]><xml><o:OfficeDocumentSettings><o:AllowPNG/>'
+                   '<o:PixelsPerInch>96</o:PixelsPerInch></o:OfficeDocumentSettings></xml><![endif]-->')
+        out.append('</head>\n<body {}>'.format(self.style()))
+        out.append(AMPSCRIPT[0])
+        length = sum(len(part) for part in out)
+        while length < self.size:
+            section = self.table(self.depth)
+            out.append(section)
+            length += len(section)
+        out.append('</body>\n</html>\n')
+        return ''.join(out)
+
+    def style(self):
+        props = [self.random.choice(STYLE_PROPS)(self.random) for p in range(self.styles)]
+        return 'style="{}"'.format('; '.join(props))
+
+    def text(self, words):
+        return ' '.join(self.random.choice(WORDS) for w in range(words))
+
+    def styleBlock(self):
+        rules = []
+        for n in range(self.random.randint(3, 8)):
+            rules.append('.c{} {{ {}; }}'.format(n, self.style()[7:-1]))
+        rules.append('@media only screen and (max-width:480px) { .c0 { width:100% !important; } }')
+        return '<style type="text/css">\n\t' + '\n\t'.join(rules) + '\n</style>'
+
+    def scriptBlock(self):
+        return ('<script type="application/ld+json">\n{"@context": "http://schema.org", '
+                '"@type": "EmailMessage", "description": "' + self.text(5) + '"}\n</script>')
+
+    def table(self, depth):
+        r = self.random
+        rows = []
+        # one cell carries the next level, so a section grows with depth
+        # rather than exponentially
+        row_count = r.randint(1, 3)
+        nested = (r.randrange(row_count), r.randint(0, 1))
+        for row in range(row_count):
+            cells = []
+            for cell in range(2 if row == nested[0] else r.randint(1, 2)):
+                if depth > 1 and (row, cell) == nested:
+                    inner = self.table(depth - 1)
+                else:
+                    inner = self.content()
+                cells.append('<td align="center" valign="top" {}>{}</td>'.format(self.style(), inner))
+            rows.append('<tr>' + ''.join(cells) + '</tr>')
+        table = ('<table width="100%" border="0" cellpadding="0" cellspacing="0" role="presentation" {}>'
+                 .format(self.style()) + '\n'.join(rows) + '</table>')
+        if r.random() < self.conditionals:
+            table = ('<!--[if mso]><table width="600" align="center"><tr><td><![endif]-->' + table +
+                     '<!--[if mso]></td></tr></table><![endif]-->')
+        if r.random() < self.ampscript:
+            table = r.choice(AMPSCRIPT) + table
+        return table
+
+    def content(self):
+        r = self.random
+        parts = []
+        for part in range(r.randint(1, 4)):
+            if r.random() < self.ampscript:
+                parts.append(r.choice(AMPSCRIPT))
+            if r.random() < self.inline:
+                parts.append(self.inlineRun())
+            elif r.random() < 0.5:
+                parts.append('<p {}>{}</p>'.format(self.style(), self.inlineRun()))
+            elif r.random() < 0.5:
+                parts.append('<img src="http://example.com/img/{}.png" width="{}" height="{}" alt="{}" border="0" {} />'
+                             .format(r.randint(1, 99), r.choice((100, 280, 600)), r.choice((50, 100, 200)),
+                                     self.text(2), self.style()))
+            else:
+                parts.append('<div {}>{}<br />{}</div>'.format(self.style(), self.text(6), self.text(4)))
+        return '\n'.join(parts)
+
+    def inlineRun(self):
+        r = self.random
+        run = [self.text(r.randint(2, 8))]
+        for n in range(r.randint(1, 3)):
+            tag = r.choice(INLINE_TAGS)
+            attrs = self.style()
+            if tag == 'a':
+                attrs = 'href="http://example.com/{}?utm_source=email&amp;id=%%=v(@id)=%%" target="_blank" {}'.format(
+                    r.randint(1, 999), attrs)
+            run.append('<{0} {1}>{2}</{0}>'.format(tag, attrs, self.text(r.randint(1, 5))))
+            run.append(self.text(r.randint(0, 4)))
+        return ' '.join(run)
+
+
+def timePhases(settings, content, repeat, layout_jobs=None):
+    """
+    Best time of each phase over repeat runs. Each run compiles the
+    settings afresh, so the css and tag memos start cold as they do for a
+    new document; warm_layout and warm_post time one more layout and post
+    pass with the memos the last run filled. Returns the times, the
+    element count, the groomed length and how many partitions the
+    parallel layout had, None without layout_jobs.
+    """
+    best = {}
+    elements = 0
+    partitions = None
+    for run in range(repeat):
+        config = HGConfig(settings)
+        groomer = HtmlGroomer(config, '')
+        times = {}
+        started = time.perf_counter()
+        parser = parserClass(config)(config, content)
+        times['parse'] = time.perf_counter() - started
+        started = time.perf_counter()
+        laid_out = parser.stack.groomed_html
+        times['layout'] = time.perf_counter() - started
+        started = time.perf_counter()
+        groomed = groomer.postProcess(laid_out)
+        times['post'] = time.perf_counter() - started
+        times['total'] = sum(times.values())
+        for phase, seconds in times.items():
+            best[phase] = min(best.get(phase, seconds), seconds)
+        elements = len(parser.stack.elements)
+        if layout_jobs:
+            # the elements of the serial layout are laid out already, and
+            # the memos are warm
+            parallel_config = HGConfig(settings)
+            parser = parserClass(parallel_config)(parallel_config, content)
+            # below two partitions groomedHtmlParallel lays out serially
+            partitions = len(parser.stack.partitions(layout_jobs * 4))
+            started = time.perf_counter()
+            parallel = parser.stack.groomedHtmlParallel(layout_jobs)
+            seconds = time.perf_counter() - started
+            best['parallel_layout'] = min(best.get('parallel_layout', seconds), seconds)
+            if parallel != laid_out:
+                raise AssertionError('parallel layout differs from the serial layout')
+    parser = parserClass(config)(config, content)
+    started = time.perf_counter()
+    laid_out = parser.stack.groomed_html
+    best['warm_layout'] = time.perf_counter() - started
+    started = time.perf_counter()
+    groomer.postProcess(laid_out)
+    best['warm_post'] = time.perf_counter() - started
+    return best, elements, len(groomed), partitions
+
+
+def benchmarkCases(sizes, depths, base_size, base_depth):
+    # (curve, size, depth): size varies at base_depth, depth at base_size
+    cases = [('size', size, base_depth) for size in sizes]
+    cases.extend(('depth', base_size, depth) for depth in depths)
+    return cases
+
+
+def runBenchmark(args):
+    settings = loadSettings(args.settings)
+    if args.tokenizer:
+        settings['tokenizer'] = args.tokenizer
+    results = []
+    for groomer_type in args.types:
+        settings['groomer_type'] = groomer_type
+        for curve, size, depth in benchmarkCases(args.sizes, args.depths, args.base_size, args.base_depth):
+            content = TemplateGenerator(args.seed, size=size, depth=depth).generate()
+            phases, elements, bytes_out, partitions = timePhases(settings, content, args.repeat, args.layout_jobs)
+            result = {
+                'case': '{}/{}/size={}/depth={}'.format(groomer_type, curve, size, depth),
+                'groomer_type': groomer_type,
+                'curve': curve,
+                'size': size,
+                'depth': depth,
+                'bytes_in': len(content),
+                'bytes_out': bytes_out,
+                'elements': elements,
+                'partitions': partitions,
+                'seconds': phases,
+                }
+            results.append(result)
+            if not args.quiet:
+                reportResult(result)
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'code': codeFingerprint(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'seed': args.seed,
+            'repeat': args.repeat,
+            'tokenizer': settings.get('tokenizer') or 'htmlparser',
+            'layout_jobs': args.layout_jobs,
+            'cpus': os.cpu_count(),
+            },
+        'results': results,
+        }
+
+
+def reportResult(result, out=None):
+    out = out or sys.stdout
+    seconds = result['seconds']
+    out.write('{:<40} {:>8} bytes {:>6} elements  parse {:7.4f}  layout {:7.4f}  post {:7.4f}  '
+              'total {:7.4f}s  {:6.2f} MB/s\n'.format(
+                  result['case'], result['bytes_in'], result['elements'], seconds['parse'],
+                  seconds['layout'], seconds['post'], seconds['total'],
+                  result['bytes_in'] / 1e6 / max(seconds['total'], 1e-9)))
+    if 'warm_layout' in seconds:
+        out.write('{:<40} with warm memos  layout {:7.4f}  post {:7.4f}\n'.format(
+            '', seconds['warm_layout'], seconds['warm_post']))
+    if 'parallel_layout' in seconds:
+        if result['partitions'] < 2:
+            out.write('{:<40} parallel layout {:7.4f}s, 1 partition, laid out serially\n'.format(
+                '', seconds['parallel_layout']))
+        else:
+            out.write('{:<40} parallel layout {:7.4f}s, {} partitions, {:.2f}x the serial layout\n'.format(
+                '', seconds['parallel_layout'], result['partitions'],
+                seconds['layout'] / max(seconds['parallel_layout'], 1e-9)))
+
+
+def compareResults(before, after, out=None):
+    """
+    Print the time of each phase in after relative to before for the
+    cases both runs have. Below 1.00 is faster.
+    """
+    out = out or sys.stdout
+    previous = dict((result['case'], result) for result in before['results'])
+    phases = ('parse', 'layout', 'post', 'total')
+    out.write('{:<40} '.format('compared to ' + before['meta']['date']) +
+              ' '.join('{:>7}'.format(phase) for phase in phases) + '\n')
+    for result in after['results']:
+        old = previous.get(result['case'])
+        if old is None:
+            continue
+        ratios = [result['seconds'][phase] / max(old['seconds'][phase], 1e-9) for phase in phases]
+        out.write('{:<40} '.format(result['case']) + ' '.join('{:7.2f}'.format(ratio) for ratio in ratios) + '\n')
+
+
+def writeCorpus(args):
+    # the generated documents, to groom with the command line or elsewhere
+    os.makedirs(args.corpus, exist_ok=True)
+    for curve, size, depth in benchmarkCases(args.sizes, args.depths, args.base_size, args.base_depth):
+        path = os.path.join(args.corpus, 'template-{}-{}-{}.htm'.format(args.seed, size, depth))
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(TemplateGenerator(args.seed, size=size, depth=depth).generate())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark HtmlGroomer on synthetic email templates.')
+    parser.add_argument('-s', '--settings', help='settings file, default HtmlGroomer.sublime-settings')
+    parser.add_argument('-t', '--type', dest='types', action='append', choices=('html', 'html_email'),
+                        help='groomer type, may repeat, default both')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[8192, 32768, 131072, 524288])
+    parser.add_argument('--depths', type=int, nargs='+', default=[1, 2, 4, 8, 12])
+    parser.add_argument('--base-size', type=int, default=65536, help='size of the depth curve documents')
+    parser.add_argument('--base-depth', type=int, default=4, help='depth of the size curve documents')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='runs per case, the best is kept')
+    parser.add_argument('--tokenizer', choices=sorted(tokenizers), help='tokenizer backend, default from the settings')
+    parser.add_argument('--layout-jobs', type=int, metavar='N',
+                        help='also time the layout on N processes and check it matches')
+    parser.add_argument('--quick', action='store_true', help='small documents and one run, for a smoke test')
+    parser.add_argument('-o', '--output', help='save the results as json')
+    parser.add_argument('-c', '--compare', help='json results of an earlier run to compare with')
+    parser.add_argument('--corpus', metavar='DIR', help="write the generated documents here and don't time them")
+    parser.add_argument('-q', '--quiet', action='store_true')
+    args = parser.parse_args(argv)
+    args.types = args.types or ['html', 'html_email']
+    if args.quick:
+        args.sizes = [4096, 16384]
+        args.depths = [2, 4]
+        args.base_size = 16384
+        args.repeat = 1
+    if args.corpus:
+        writeCorpus(args)
+        return 0
+
+    report = runBenchmark(args)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compareResults(json.load(f), report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+"""
+
+HtmlGroomer thin client
+
+Grooms files with a server started by python -m html_groomer --serve,
+pipelining them over one connection. It imports only the standard
+library, not the groomer, so a run costs the Python start and a round
+trip per file.
+
+Usage:
+    python tools/client.py /tmp/html_groomer.sock page.htm > groomed.htm
+    python tools/client.py 8765 --type html_email --in-place templates/*.htm
+    cat page.htm | python tools/client.py 8765 -
+    python tools/client.py 8765 --stats
+
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+
+
+def connect(address):
+    # a socket path, or [host:]port on localhost, as the server takes them
+    if os.sep in address or address.endswith('.sock'):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(address)
+        return connection
+    host, sep, port = address.rpartition(':')
+    connection = socket.create_connection((host or '127.0.0.1', int(port)))
+    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return connection
+
+
+def exchange(connection, requests, window=16):
+    # yield the reply to each request in order, with up to window in flight
+    reader = connection.makefile('rb')
+    replies = {}
+    sent = []
+    for request_id, request in enumerate(requests):
+        request['id'] = request_id
+        connection.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        sent.append(request_id)
+        while len(sent) >= window or (request_id == len(requests) - 1 and sent):
+            while sent[0] not in replies:
+                line = reader.readline()
+                if not line:
+                    raise IOError('the server closed the connection')
+                reply = json.loads(line.decode('utf-8'))
+                replies[reply.get('id')] = reply
+            yield replies.pop(sent.pop(0))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Groom files with a running html groomer server.')
+    parser.add_argument('address', help='socket path or [host:]port of the server')
+    parser.add_argument('paths', nargs='*', help='html files, - for stdin')
+    parser.add_argument('-t', '--type', dest='groomer_type', default='html', choices=('html', 'html_email'))
+    parser.add_argument('--set', dest='overrides', action='append', default=[], metavar='KEY=JSON',
+                        help='override one setting, may repeat')
+    parser.add_argument('-i', '--in-place', action='store_true', help='write groomed files back in place')
+    parser.add_argument('--stats', action='store_true', help="print the server's stats")
+    args = parser.parse_intermixed_args(argv)
+    settings = {}
+    for override in args.overrides:
+        key, sep, value = override.partition('=')
+        try:
+            settings[key.strip()] = json.loads(value)
+        except ValueError:
+            settings[key.strip()] = value
+    requests = []
+    for path in args.paths:
+        if path == '-':
+            content = sys.stdin.read()
+        else:
+            with open(path, encoding='utf-8', newline='') as f:
+                content = f.read()
+        requests.append({'content': content, 'groomer_type': args.groomer_type, 'settings': settings})
+    if args.stats:
+        requests.append({'op': 'stats'})
+    if not requests:
+        parser.error('no paths given')
+    connection = connect(args.address)
+    errors = 0
+    try:
+        for path, reply in zip(args.paths + ['stats'], exchange(connection, requests)):
+            if 'error' in reply:
+                errors += 1
+                sys.stderr.write('error: {}: {}\n'.format(path, reply['error']))
+            elif 'stats' in reply:
+                sys.stdout.write(json.dumps(reply['stats'], indent=2, sort_keys=True) + '\n')
+            elif args.in_place and path != '-':
+                if reply['changed']:
+                    with open(path + '.tmp', 'w', encoding='utf-8', newline='') as f:
+                        f.write(reply['groomed'])
+                    os.replace(path + '.tmp', path)
+            else:
+                sys.stdout.write(reply['groomed'])
+    finally:
+        connection.close()
+    return 2 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,114 @@
+"""
+
+HtmlGroomer tokenizer conformance
+
+Parses documents with every tokenizer backend and checks they build the same
+HGStack: the same elements, in the same order, with the same kind, name,
+parent, attributes and content. Runs over html files and seeded synthetic
+email templates, for both groomer types, with and without
+indent_conditionals, and exits 1 at the first difference.
+
+Usage:
+    python tools/conformance.py
+    python tools/conformance.py tests/ corpus/ --seeds 50
+    python tools/conformance.py --backends htmlparser regex
+
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from html_groomer import HGConfig, loadSettings, tokenizers
+from html_groomer_cli import findHtmlFiles
+from benchmark import TemplateGenerator
+
+
+def elementRows(config, content, stream_chunk=None):
+    # the stack a backend builds, as HGElement.trace() rows
+    parser_class = tokenizers[config.tokenizer]
+    if stream_chunk is None:
+        return parser_class(config, content).stack.elementTable()
+    parser = parser_class(config, content, stream=True)
+    rows = []
+    for begin in range(0, len(content), stream_chunk):
+        parser.feed(content[begin:begin + stream_chunk])
+        rows.extend(e.trace() for e in parser.stack.takeElements())
+    parser.close()
+    rows.extend(e.trace() for e in parser.stack.takeElements())
+    return rows
+
+
+def compareTokenizers(settings, content, backends=None, stream_chunk=None):
+    """
+    None if every backend builds the same elements from content, otherwise
+    (index, {backend: row}) for the first element that differs
+    """
+    backends = backends or sorted(tokenizers)
+    tables = {}
+    for backend in backends:
+        values = dict(settings)
+        values['tokenizer'] = backend
+        tables[backend] = elementRows(HGConfig(values), content, stream_chunk)
+    reference = tables[backends[0]]
+    for backend in backends[1:]:
+        table = tables[backend]
+        for index in range(max(len(reference), len(table))):
+            left = reference[index] if index < len(reference) else None
+            right = table[index] if index < len(table) else None
+            if left != right:
+                return index, dict((name, rows[index] if index < len(rows) else None)
+                                   for name, rows in tables.items())
+    return None
+
+
+def documents(args):
+    # (label, content) for the files and generated templates
+    for path, relative in findHtmlFiles(args.paths):
+        with open(path, encoding='utf-8', errors='surrogateescape') as f:
+            yield path, f.read()
+    for seed in range(args.seeds):
+        generator = TemplateGenerator(seed, size=args.size, depth=1 + seed % 6,
+                                      inline=(seed % 5) / 4.0, conditionals=(seed % 3) / 3.0)
+        yield 'template seed={}'.format(seed), generator.generate()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check that tokenizer backends build the same elements.')
+    parser.add_argument('paths', nargs='*', help='html files or directories, default tests/')
+    parser.add_argument('-s', '--settings', help='settings file, default HtmlGroomer.sublime-settings')
+    parser.add_argument('-b', '--backends', nargs='+', choices=sorted(tokenizers),
+                        help='backends to compare, the first is the reference, default all')
+    parser.add_argument('--seeds', type=int, default=20, help='synthetic templates to generate')
+    parser.add_argument('--size', type=int, default=16384, help='size of the synthetic templates')
+    parser.add_argument('--stream', type=int, metavar='CHARS', help='also feed the documents in chunks this big')
+    args = parser.parse_args(argv)
+    if not args.paths:
+        args.paths = [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests')]
+    backends = args.backends or sorted(tokenizers, key=lambda name: name != 'htmlparser')
+    settings = loadSettings(args.settings)
+    checked = 0
+    for label, content in documents(args):
+        for groomer_type in ('html', 'html_email'):
+            for indent_conditionals in (True, False):
+                settings['groomer_type'] = groomer_type
+                settings['indent_conditionals'] = indent_conditionals
+                for stream_chunk in (None, args.stream) if args.stream else (None,):
+                    difference = compareTokenizers(settings, content, backends, stream_chunk)
+                    checked += 1
+                    if difference is not None:
+                        index, rows = difference
+                        sys.stdout.write('{} ({}, indent_conditionals={}{}): element {} differs\n'.format(
+                            label, groomer_type, indent_conditionals,
+                            ', stream' if stream_chunk else '', index))
+                        for backend, row in rows.items():
+                            sys.stdout.write('  {:<12}{!r}\n'.format(backend, row))
+                        return 1
+    sys.stdout.write('{} backends agree on {} parses\n'.format(', '.join(backends), checked))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
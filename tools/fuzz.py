@@ -0,0 +1,311 @@
+"""
+
+HtmlGroomer differential fuzzer
+
+Grooms randomized and mutated email html with a frozen reference groomer
+and with the working tree, under several settings profiles, and fails on
+the first outputs that are not byte-identical. The reference is
+tools/reference/html_groomer.py by default, the groomer as it was at
+b08af28, before the performance work began. It doesn't move with later
+commits, so drift in behaviour can't build up unseen. Any other file or
+git revision can be the reference; --reference HEAD checks a change
+against the code it replaces before it's committed. Failing inputs are
+minimized a token at a time, and the time each groomer took is summed
+into a relative throughput.
+
+Inputs are seeded synthetic templates and the html files given, each
+groomed as is and after random mutations: tags dropped, repeated or
+swapped, whitespace reshuffled, and snippets that stress inline
+propagation, collapsed &nbsp; containers, br runs and conditional
+comments spliced in.
+
+The compact-stream profile is for a setting the frozen reference
+predates: the working tree fed in small chunks has to match itself
+groomed whole.
+
+Usage:
+    python tools/fuzz.py
+    python tools/fuzz.py --reference HEAD
+    python tools/fuzz.py --reference b08af28 --seeds 200 --seconds 600
+    python tools/fuzz.py --reference old_html_groomer.py tests/ corpus/
+    python tools/fuzz.py --profiles email xhtml --set-current tokenizer='"regex"'
+    python tools/fuzz.py --stream 7 --save failures/
+
+"""
+
+import argparse
+import copy
+import logging
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# the groomer at b08af28, frozen and never edited
+REFERENCE = os.path.join(ROOT, 'tools', 'reference', 'html_groomer.py')
+
+import html_groomer
+from html_groomer import lineDifference, loadSettings
+from html_groomer_cli import findHtmlFiles, parseOverride
+from benchmark import TemplateGenerator
+
+
+PROFILES = [
+    ('html', {'groomer_type': 'html'}),
+    ('email', {'groomer_type': 'html_email'}),
+    ('xhtml', {'groomer_type': 'html_email', 'force_xhtml': True}),
+    ('native', {'groomer_type': 'html', 'use_native_indent': True}),
+    ('flat', {'groomer_type': 'html_email', 'indent_conditionals': False}),
+    ('plain', {'groomer_type': 'html', 'format_css': False, 'expand_hexcolors': False}),
+    ('spaces', {'groomer_type': 'html_email', 'indent_unit': '  ', 'break_unit': '\r\n'}),
+    ('compact-stream', {'groomer_type': 'html_email', 'compact': True}),
+    ]
+# profiles for settings the frozen reference doesn't have: the working
+# tree fed in chunks this big is checked against itself groomed whole
+SELF_CHECKED = {'compact-stream': 61}
+SNIPPETS = [
+    '&nbsp;', '<td>&nbsp;</td>', '<p>&nbsp;</p>', '<div> &nbsp; </div>',
+    '<br>', '<br><br>', '<br/>\n<br/>\n<br/>', 'text<br>more',
+    '<span style="display:block">block span</span>', '<div style="display:inline">inline div</div>',
+    '<a href="http://example.com/">link <b>bold</b></a>', '<b>', '</b>', '<span>', '</span>', '</td>', '</div>',
+    '<img src="x.gif" alt="">', '<img src="http://movableink.com/p/x.png" alt="">',
+    '<!--[if mso]><table><tr><td><![endif]-->', '<!--[if mso]></td></tr></table><![endif]-->',
+    '<!--[if !mso]><!--><div>not outlook</div><!--<![endif]-->', '<!--[if gte mso 9]><v:rect fill="true"><![endif]-->',
+    '<!-- %%[ SET @x = 1 ]%% -->', '<!-- plain comment -->',
+    '<style>\n  .a { color:#ABC; }\n\t.b{margin:0}\n</style>', '<script>\n    var x = 1;\n</script>',
+    '<table><tr><td>cell</td></tr></table>', '<tbody>', '</tbody>',
+    ' ', '\n', '\n\t\t', '    ', 'café &amp; crème', '<P CLASS="x">Upper</P>',
+    '<td style="color:#fff;color:#000;font-size:12px">dupe</td>', '<font color="#abc" face="Arial">f</font>',
+    ]
+token_pat = re.compile(r'<!--.*?-->|<[^>]*>|[^<]+|<', re.DOTALL)
+
+
+def loadReference(reference):
+    """
+    html_groomer as of a git revision, or from a file, as a module of its
+    own next to the working tree one
+    """
+    if os.path.isfile(reference):
+        with open(reference, encoding='utf-8') as f:
+            source = f.read()
+        label = reference
+    else:
+        source = subprocess.check_output(['git', 'show', '{}:html_groomer.py'.format(reference)],
+                                         cwd=ROOT).decode('utf-8')
+        label = '{}:html_groomer.py'.format(reference)
+    module = types.ModuleType('html_groomer_reference')
+    module.__file__ = label
+    sys.modules[module.__name__] = module
+    exec(compile(source, label, 'exec'), module.__dict__)
+    return module
+
+
+def groom(module, settings, content, stream_chunk=None):
+    # the groomed html, or the exception raised, and the seconds it took
+    started = time.perf_counter()
+    try:
+        if stream_chunk:
+            # with the document to detect from, output starts with the first
+            # chunk rather than after stream_sniff_size, so cuts get exercised
+            groomer = module.HtmlGroomer(copy.deepcopy(settings), document=content)
+            chunks = [content[begin:begin + stream_chunk] for begin in range(0, len(content), stream_chunk)]
+            result = ''.join(groomer.iterGroomed(chunks))
+        else:
+            result = module.HtmlGroomer(copy.deepcopy(settings), content).getGroomed()
+    except Exception as e:
+        result = e
+    return result, time.perf_counter() - started
+
+
+def mutate(r, content, count):
+    # count random edits to the tokens of content
+    tokens = token_pat.findall(content)
+    for m in range(count):
+        at = r.randrange(len(tokens) + 1)
+        edit = r.randrange(6)
+        if edit == 0 and at < len(tokens):
+            del tokens[at]
+        elif edit == 1 and at < len(tokens):
+            tokens.insert(at, tokens[at])
+        elif edit == 2 and at + 1 < len(tokens):
+            tokens[at], tokens[at + 1] = tokens[at + 1], tokens[at]
+        elif edit == 3 and at < len(tokens) and not tokens[at].startswith('<'):
+            tokens[at] = re.sub(r'\s+', lambda match: r.choice((' ', '\n', '\n\t\t', '  ', '')), tokens[at])
+        else:
+            tokens.insert(at, r.choice(SNIPPETS))
+    return ''.join(tokens)
+
+
+def minimize(content, fails, attempts=2000):
+    """
+    A smaller content which still fails: chunks of tokens are dropped
+    while fails(content) holds, halving the chunks when none can go
+    """
+    tokens = token_pat.findall(content)
+    parts = 2
+    while len(tokens) > 1 and attempts > 0:
+        size = -(-len(tokens) // parts)
+        for begin in range(0, len(tokens), size):
+            candidate = tokens[:begin] + tokens[begin + size:]
+            attempts -= 1
+            if fails(''.join(candidate)):
+                tokens = candidate
+                parts = max(parts - 1, 2)
+                break
+            if attempts <= 0:
+                break
+        else:
+            if size == 1:
+                break
+            parts = min(parts * 2, len(tokens))
+    return ''.join(tokens)
+
+
+def inputs(args):
+    # (label, content) for every document to compare
+    bases = []
+    for path, relative in findHtmlFiles(args.paths):
+        with open(path, encoding='utf-8', errors='surrogateescape') as f:
+            bases.append((path, f.read()))
+    for label, content in bases:
+        yield label, content
+    for seed in range(args.seeds):
+        r = random.Random(seed)
+        if bases and seed % 4 == 0:
+            label, content = bases[seed // 4 % len(bases)]
+        else:
+            generator = TemplateGenerator(seed, size=args.size, depth=1 + seed % 5, inline=(seed % 5) / 4.0,
+                                          conditionals=(seed % 3) / 3.0, blocks=seed % 3)
+            label, content = 'template seed={}'.format(seed), generator.generate()
+            yield label, content
+        yield '{} mutated seed={}'.format(label, seed), mutate(r, content, r.randint(1, args.mutations))
+
+
+class Report():
+
+    """
+    Failures and timings of one run
+    """
+
+    def __init__(self, out):
+        self.out = out
+        self.compared = 0
+        self.reference_errors = 0
+        self.failures = 0
+        self.bytes = 0
+        self.reference_seconds = 0.0
+        self.current_seconds = 0.0
+
+    def failure(self, label, profile, reference, current, content, save=None):
+        self.failures += 1
+        self.out.write('FAIL {} [{}]\n'.format(label, profile))
+        if isinstance(current, Exception):
+            self.out.write('  current raised {}: {}\n'.format(type(current).__name__, current))
+        else:
+            line, expected, got = lineDifference(reference, current)
+            self.out.write('  line {}:\n  - {!r}\n  + {!r}\n'.format(line, expected, got))
+        self.out.write('  minimized input ({} chars):\n'.format(len(content)))
+        for line in content.splitlines() or ['']:
+            self.out.write('    {}\n'.format(line))
+        if save:
+            os.makedirs(save, exist_ok=True)
+            path = os.path.join(save, 'fuzz-{}-{}.htm'.format(self.failures, profile))
+            with open(path, 'w', encoding='utf-8', errors='surrogateescape') as f:
+                f.write(content)
+            self.out.write('  saved {}\n'.format(path))
+
+    def summary(self):
+        reference = self.bytes / 1e6 / max(self.reference_seconds, 1e-9)
+        current = self.bytes / 1e6 / max(self.current_seconds, 1e-9)
+        self.out.write('{} comparisons, {} failures, {} skipped where the reference raised\n'.format(
+            self.compared, self.failures, self.reference_errors))
+        if not self.bytes:
+            # only self-checked profiles ran
+            return
+        self.out.write('throughput: reference {:.2f} MB/s, current {:.2f} MB/s, {:.2f}x\n'.format(
+            reference, current, current / max(reference, 1e-9)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare the groomer against a frozen reference on fuzzed html.')
+    parser.add_argument('paths', nargs='*', help='html files or directories to mutate, default tests/')
+    parser.add_argument('-r', '--reference', default=REFERENCE,
+                        help='file or git revision of the reference groomer, default tools/reference/html_groomer.py')
+    parser.add_argument('-s', '--settings', help='settings file, default HtmlGroomer.sublime-settings')
+    parser.add_argument('-p', '--profiles', nargs='+', choices=[name for name, overrides in PROFILES],
+                        help='settings profiles to run, default all')
+    parser.add_argument('--set-current', dest='current_overrides', action='append', default=[], metavar='KEY=JSON',
+                        help='setting for the current groomer only, to compare an optional path, may repeat')
+    parser.add_argument('--stream', type=int, metavar='CHARS', help='feed the current groomer in chunks this big')
+    parser.add_argument('--seeds', type=int, default=50, help='inputs to generate')
+    parser.add_argument('--size', type=int, default=4096, help='size of the synthetic templates')
+    parser.add_argument('--mutations', type=int, default=8, help='most mutations applied to an input')
+    parser.add_argument('--seconds', type=float, default=0, help='stop generating inputs after this long')
+    parser.add_argument('--max-failures', type=int, default=3, help='stop after this many failures')
+    parser.add_argument('--save', metavar='DIR', help='write minimized failing inputs here')
+    args = parser.parse_args(argv)
+    if not args.paths:
+        args.paths = [os.path.join(ROOT, 'tests')]
+    # both groomers warn about unbalanced tags, which the mutations are full of
+    logging.disable(logging.WARNING)
+
+    reference = loadReference(args.reference)
+    settings = loadSettings(args.settings)
+    current_overrides = {}
+    for override in args.current_overrides:
+        try:
+            key, value = parseOverride(override)
+        except ValueError as e:
+            parser.error(str(e))
+        current_overrides[key] = value
+    profiles = [(name, overrides) for name, overrides in PROFILES if not args.profiles or name in args.profiles]
+
+    report = Report(sys.stdout)
+    started = time.perf_counter()
+    for label, content in inputs(args):
+        if args.seconds and time.perf_counter() - started > args.seconds:
+            break
+        for name, overrides in profiles:
+            reference_settings = dict(settings, **overrides)
+            current_settings = dict(reference_settings, **current_overrides)
+            if name in SELF_CHECKED:
+                oracle, stream = html_groomer, args.stream or SELF_CHECKED[name]
+            else:
+                oracle, stream = reference, args.stream
+
+            def fails(candidate):
+                expected, seconds = groom(oracle, reference_settings, candidate)
+                if isinstance(expected, Exception):
+                    return False
+                got, seconds = groom(html_groomer, current_settings, candidate, stream)
+                return isinstance(got, Exception) or got != expected
+
+            expected, reference_seconds = groom(oracle, reference_settings, content)
+            got, current_seconds = groom(html_groomer, current_settings, content, stream)
+            report.compared += 1
+            if isinstance(expected, Exception):
+                report.reference_errors += 1
+                continue
+            if oracle is reference:
+                report.bytes += len(content.encode('utf-8', 'surrogateescape'))
+                report.reference_seconds += reference_seconds
+                report.current_seconds += current_seconds
+            if isinstance(got, Exception) or got != expected:
+                small = minimize(content, fails)
+                expected, seconds = groom(oracle, reference_settings, small)
+                got, seconds = groom(html_groomer, current_settings, small, stream)
+                report.failure(label, name, expected, got, small, args.save)
+                if report.failures >= args.max_failures:
+                    report.summary()
+                    return 1
+    report.summary()
+    return 1 if report.failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,86 @@
+"""
+
+HtmlGroomer selection grooms
+
+Checks groomRegions, which grooms just the blocks around the selections,
+against full grooms. Each document is groomed in full, and a document
+that grooms back to itself must come through a selection groom unchanged:
+cursors are put at random offsets, the regions are spliced in, and the
+result has to be byte-identical. Runs over html files and seeded
+synthetic email templates, for both groomer types, and exits 1 at the
+first difference.
+
+Usage:
+    python tools/selections.py
+    python tools/selections.py tests/ corpus/ --seeds 50 --cursors 20
+
+"""
+
+import argparse
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from html_groomer import HGConfig, HtmlGroomer, groomRegions, lineDifference, loadSettings
+from html_groomer_cli import findHtmlFiles
+from benchmark import TemplateGenerator
+
+
+def spliceRegions(content, replacements):
+    # content with the (begin, end, groomed) replacements made, last first
+    for begin, end, groomed in reversed(replacements):
+        content = content[:begin] + groomed + content[end:]
+    return content
+
+
+def documents(args):
+    # (label, content) for the files and generated templates
+    for path, relative in findHtmlFiles(args.paths):
+        with open(path, encoding='utf-8', errors='surrogateescape') as f:
+            yield path, f.read()
+    for seed in range(args.seeds):
+        generator = TemplateGenerator(seed, size=args.size, depth=1 + seed % 6,
+                                      inline=(seed % 5) / 4.0, conditionals=(seed % 3) / 3.0)
+        yield 'template seed={}'.format(seed), generator.generate()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check that selection grooms agree with full grooms.')
+    parser.add_argument('paths', nargs='*', help='html files or directories, default tests/')
+    parser.add_argument('-s', '--settings', help='settings file, default HtmlGroomer.sublime-settings')
+    parser.add_argument('--seeds', type=int, default=30, help='synthetic templates to generate')
+    parser.add_argument('--size', type=int, default=4096, help='size of the synthetic templates')
+    parser.add_argument('--cursors', type=int, default=10, help='cursors to try in each document')
+    args = parser.parse_args(argv)
+    if not args.paths:
+        args.paths = [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests')]
+    settings = loadSettings(args.settings)
+    checked = skipped = 0
+    for label, content in documents(args):
+        for groomer_type in ('html', 'html_email'):
+            settings['groomer_type'] = groomer_type
+            config = HGConfig(settings)
+            groomed = HtmlGroomer(config, content).getGroomed()
+            if HtmlGroomer(config, groomed).getGroomed() != groomed:
+                # grooming doesn't settle on this one, so there's nothing to hold to
+                skipped += 1
+                continue
+            r = random.Random(label)
+            for cursor in range(args.cursors):
+                at = r.randrange(len(groomed) + 1)
+                result = spliceRegions(groomed, groomRegions(config, groomed, [(at, at)]))
+                checked += 1
+                if result != groomed:
+                    line, expected, got = lineDifference(groomed, result)
+                    sys.stdout.write('{} ({}): cursor at {} changes line {}\n  - {!r}\n  + {!r}\n'.format(
+                        label, groomer_type, at, line, expected, got))
+                    return 1
+    sys.stdout.write('{} selection grooms leave groomed documents unchanged, {} documents skipped\n'.format(
+        checked, skipped))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())